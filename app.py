@@ -1,146 +1,69 @@
+import worker_startup  # First, so its clock covers the imports below
 import os
-import cv2
-import numpy as np
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, url_for
 from werkzeug.utils import secure_filename
-import mediapipe as mp
-from PIL import Image
-import json
-import threading
-import time
+from batch import iter_process_images
+from chunked_upload import ChunkedUploadStore
+from config import DETECTION_RETENTION_DAYS, DETECTION_STORE, MULTI_FACE
+from cropper import DETECTION_PARAMETERS
+from detection_store import get_detection_store
+from frame_source import frame_sampling_options
+from image_probe import ImageRejected, save_probe
+from janitor import Janitor, remove_stale
+from jobs import JobStore, iter_job_events, start_job_runner, submit_job
+import metrics
+from output_encoding import encoding_options, output_extension
+from zip_stream import iter_zip
 
 app = Flask(__name__)
+worker_startup.track_first_request(app)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'cropped_images'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size (increased from 16MB)
 app.config['MAX_CONTENT_PATH'] = None  # Allow longer file paths
+app.config['JOB_DATABASE'] = 'jobs.db'  # Job progress shared by all workers
+app.config['JOB_RETENTION'] = 24 * 3600  # Seconds finished jobs and their results are kept
+app.config['PARTIAL_UPLOAD_FOLDER'] = os.path.join('uploads', '.partial')  # Resumable uploads in progress
+app.config['PARTIAL_UPLOAD_RETENTION'] = 24 * 3600  # Seconds a resumable upload is kept after its last chunk
+app.config['MAX_CHUNKED_UPLOAD_SIZE'] = app.config['MAX_CONTENT_LENGTH']  # Largest size a resumable upload may declare
+app.config['JANITOR_INTERVAL'] = 3600  # Seconds between background cleanup sweeps
+app.config['JANITOR_LOCK'] = 'janitor.lock'  # Lets one worker sweep at a time
 
 # Create directories if they don't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
-# Initialize MediaPipe - using correct import structure
-mp_face_detection = mp.solutions.face_detection
+# Background /process jobs, visible from every gunicorn worker
+job_store = JobStore(app.config['JOB_DATABASE'])
+
+# Resumable chunked uploads, streamed next to their final location
+chunked_uploads = ChunkedUploadStore(app.config['PARTIAL_UPLOAD_FOLDER'])
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'mp4', 'mov', 'avi', 'mkv', 'webm'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def detect_face_and_tie(image_path):
-    """Detect face and tie area using AI for ID card style cropping"""
-    try:
-        # Read image
-        image = cv2.imread(image_path)
-        if image is None:
-            return None, "Could not read image"
-        
-        # Convert to RGB for MediaPipe
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Initialize face detection with latest MediaPipe
-        with mp_face_detection.FaceDetection(
-            model_selection=1, min_detection_confidence=0.5) as face_detection:
-            
-            results = face_detection.process(rgb_image)
-            
-            if results.detections:
-                # Get the first detected face
-                detection = results.detections[0]
-                bbox = detection.location_data.relative_bounding_box
-                
-                h, w, _ = image.shape
-                x = int(bbox.xmin * w)
-                y = int(bbox.ymin * h)
-                width = int(bbox.width * w)
-                height = int(bbox.height * h)
-                
-                # Expand the crop area to include tie knot area
-                # ID card style: face + upper chest area with tie
-                expanded_height = int(height * 2.5)  # Include chest area
-                expanded_width = int(width * 1.8)   # Include shoulders
-                
-                # Adjust coordinates to stay within image bounds
-                start_x = max(0, x - (expanded_width - width) // 2)
-                start_y = max(0, y - (expanded_height - height) // 2)
-                end_x = min(w, start_x + expanded_width)
-                end_y = min(h, start_y + expanded_height)
-                
-                # Ensure minimum dimensions
-                if end_x - start_x < 200:
-                    center_x = (start_x + end_x) // 2
-                    start_x = max(0, center_x - 100)
-                    end_x = min(w, center_x + 100)
-                
-                if end_y - start_y < 300:
-                    center_y = (start_y + end_y) // 2
-                    start_y = max(0, center_y - 150)
-                    end_y = min(h, center_y + 150)
-                
-                return {
-                    'x': start_x,
-                    'y': start_y,
-                    'width': end_x - start_x,
-                    'height': end_y - start_y
-                }, None
-            else:
-                # Fallback: use center crop if no face detected
-                h, w, _ = image.shape
-                center_x, center_y = w // 2, h // 2
-                crop_size = min(w, h) // 2
-                
-                return {
-                    'x': max(0, center_x - crop_size // 2),
-                    'y': max(0, center_y - crop_size // 2),
-                    'width': min(crop_size, w),
-                    'height': min(crop_size, h)
-                }, "No face detected, using center crop"
-                
-    except Exception as e:
-        return None, str(e)
+def janitor_sweep():
+    # Abandoned resumable uploads
+    remove_stale(app.config['PARTIAL_UPLOAD_FOLDER'], app.config['PARTIAL_UPLOAD_RETENTION'])
+    job_store.prune(app.config['JOB_RETENTION'])
+    detections = get_detection_store(DETECTION_STORE, DETECTION_PARAMETERS)
+    if detections is not None:
+        detections.prune(DETECTION_RETENTION_DAYS * 24 * 3600)
 
-def crop_image(image_path, crop_coords, output_path):
-    """Crop image based on detected coordinates and maintain 1:1.285 aspect ratio"""
-    try:
-        image = cv2.imread(image_path)
-        if image is None:
-            return False, "Could not read image"
-        
-        # First crop the image based on detected coordinates
-        cropped = image[
-            crop_coords['y']:crop_coords['y'] + crop_coords['height'],
-            crop_coords['x']:crop_coords['x'] + crop_coords['width']
-        ]
-        
-        # Now resize to maintain 1:1.285 aspect ratio
-        # Target aspect ratio: 1:1.285 = 0.778
-        target_ratio = 1.0 / 1.285  # width/height ratio
-        
-        h, w = cropped.shape[:2]
-        current_ratio = w / h
-        
-        if current_ratio > target_ratio:
-            # Image is too wide, need to reduce width
-            new_width = int(h * target_ratio)
-            new_height = h
-            # Center crop horizontally
-            start_x = (w - new_width) // 2
-            cropped = cropped[:, start_x:start_x + new_width]
-        elif current_ratio < target_ratio:
-            # Image is too tall, need to reduce height
-            new_width = w
-            new_height = int(w / target_ratio)
-            # Center crop vertically
-            start_y = (h - new_height) // 2
-            cropped = cropped[start_y:start_y + new_height, :]
-        
-        # Save cropped image with correct aspect ratio
-        cv2.imwrite(output_path, cropped)
-        return True, "Success"
-        
-    except Exception as e:
-        return False, str(e)
+# Abandoned uploads, finished jobs and saved detections expire off the request path, one worker at a time
+janitor = Janitor(janitor_sweep, app.config['JANITOR_INTERVAL'], app.config['JANITOR_LOCK'])
+
+@app.before_request
+def start_janitor():
+    janitor.ensure_started()
+
+@app.before_request
+def resume_jobs():
+    # Also picks up jobs left unfinished by a recycled or crashed worker
+    start_job_runner()
 
 @app.route('/')
 def index():
@@ -167,6 +90,7 @@ def upload_files():
             return jsonify({'error': 'No files selected'}), 400
         
         uploaded_files = []
+        rejected_files = []
         for i, file in enumerate(files):
             print(f"Processing file {i+1}: {file.filename}")
             
@@ -179,84 +103,257 @@ def upload_files():
                 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
                 
                 file.save(filepath)
+                metrics.inc('crop_upload_bytes_total', os.path.getsize(filepath))
+                
+                # Check dimensions from the header before anything decodes it
+                try:
+                    save_probe(filepath)
+                except ImageRejected as e:
+                    print(f"Rejected {filepath}: {e}")
+                    rejected_files.append({'file': filename, 'error': str(e)})
+                    continue
                 uploaded_files.append(filepath)
                 print(f"Successfully saved: {filepath}")
             else:
                 print(f"File {file.filename} not allowed or invalid")
         
         print(f"Total uploaded: {len(uploaded_files)}")
+        if rejected_files and not uploaded_files:
+            return jsonify({'error': 'No acceptable images', 'rejected': rejected_files}), 400
         return jsonify({
             'message': f'{len(uploaded_files)} files uploaded successfully',
-            'files': uploaded_files
+            'files': uploaded_files,
+            'rejected': rejected_files
         })
         
     except Exception as e:
         print(f"Upload error: {str(e)}")
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
+def get_output_path(image_path, encoding):
+    """Generate the cropped output path for an uploaded image"""
+    filename = os.path.basename(image_path)
+    name = os.path.splitext(filename)[0]
+    output_filename = f"{name}_cropped{output_extension(image_path, encoding)}"
+    return os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+
+def process_image_batch(image_paths, encoding, multi_face=False, sampling=None):
+    """Crop images on the batch engine, yielding /process result entries in input order
+
+    In multi-face mode each entry also lists its faces, and videos and
+    multi-frame images list their cropped frames; "output" and "crop_coords"
+    then describe the first crop.
+    """
+    tasks = [(image_path, get_output_path(image_path, encoding)) for image_path in image_paths]
+    
+    for (image_path, output_path), (success, message, crop_coords) in zip(
+            tasks, iter_process_images(tasks, encoding=encoding, multi_face=multi_face,
+                                       sampling=sampling)):
+        if success and isinstance(crop_coords, list):
+            yield {
+                'input': image_path,
+                'output': crop_coords[0]['output'],
+                'success': success,
+                'message': message,
+                'crop_coords': crop_coords[0]['crop_coords'],
+                'frames' if 'frame' in crop_coords[0] else 'faces': crop_coords
+            }
+            continue
+        yield {
+            'input': image_path,
+            'output': output_path if success else None,
+            'success': success,
+            'message': message,
+            'crop_coords': crop_coords
+        }
+
+@job_store.runner
+def run_crop_job(image_paths, owner, options):
+    """A background /process job's work; whichever worker claims the job runs it"""
+    return process_image_batch(image_paths, options['encoding'], options['multi_face'],
+                               options['sampling'])
+
+@app.route('/upload/chunked', methods=['POST'])
+def start_chunked_upload():
+    """Open a resumable upload; the body is JSON with the file's name and size in bytes"""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    size = data.get('size')
+    
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'Invalid file size'}), 400
+    if size > app.config['MAX_CHUNKED_UPLOAD_SIZE']:
+        return jsonify({'error': 'File too large'}), 413
+    
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))
+    upload_id = chunked_uploads.create(filepath, size)
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'size': size}), 201
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Report the acknowledged offset so a client can resume"""
+    upload = chunked_uploads.get(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': upload['offset'],
+        'size': upload['size'],
+        'complete': upload['complete'],
+        'file': upload['final_path'] if upload['complete'] else None
+    })
+
+@app.route('/upload/chunked/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Stream one chunk, starting at the Upload-Offset header, straight to disk"""
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    
+    upload = chunked_uploads.get(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    new_offset, error = chunked_uploads.write_chunk(upload_id, offset, request.stream)
+    if new_offset is not None and not error:
+        metrics.inc('crop_upload_bytes_total', new_offset - offset)
+    if error:
+        return jsonify({'error': error, 'offset': new_offset}), 409
+    
+    complete = new_offset == upload['size']
+    if complete:
+        try:
+            save_probe(upload['final_path'])
+        except ImageRejected as e:
+            return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': new_offset,
+        'complete': complete,
+        'file': upload['final_path'] if complete else None
+    })
+
 @app.route('/process', methods=['POST'])
 def process_images():
+    """Start a background crop job; pass "wait": true for the old blocking response
+
+    Follow the job at "status_url", or stream its results as they finish
+    from "events_url" (Server-Sent Events).
+
+    Optional "format", "quality", "progressive" and "target_kb" fields
+    override the output encoding settings in config.py; "multi_face": true
+    crops every detected face. "frame_step", "sharpest_frame" and
+    "max_frames" choose the frames cropped from videos and multi-frame images.
+    """
     data = request.get_json()
     image_paths = data.get('image_paths', [])
     
     if not image_paths:
         return jsonify({'error': 'No images to process'}), 400
     
-    results = []
-    total = len(image_paths)
+    try:
+        encoding = encoding_options(data.get('format'), data.get('quality'),
+                                    data.get('progressive'), data.get('target_kb'),
+                                    data.get('size'))
+        sampling = frame_sampling_options(data.get('frame_step'), data.get('sharpest_frame'),
+                                          data.get('max_frames'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    for i, image_path in enumerate(image_paths):
-        try:
-            # Detect face and tie area
-            crop_coords, message = detect_face_and_tie(image_path)
-            
-            if crop_coords:
-                # Generate output filename
-                filename = os.path.basename(image_path)
-                name, ext = os.path.splitext(filename)
-                output_filename = f"{name}_cropped{ext}"
-                output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-                
-                # Crop the image
-                success, crop_message = crop_image(image_path, crop_coords, output_path)
-                
-                results.append({
-                    'input': image_path,
-                    'output': output_path if success else None,
-                    'success': success,
-                    'message': crop_message or message,
-                    'crop_coords': crop_coords if success else None
-                })
-            else:
-                results.append({
-                    'input': image_path,
-                    'output': None,
-                    'success': False,
-                    'message': message,
-                    'crop_coords': None
-                })
-                
-        except Exception as e:
-            results.append({
-                'input': image_path,
-                'output': None,
-                'success': False,
-                'message': str(e),
-                'crop_coords': None
-            })
+    multi_face = bool(data.get('multi_face', MULTI_FACE))
     
+    if data.get('wait'):
+        results = list(process_image_batch(image_paths, encoding, multi_face, sampling))
+        return jsonify({
+            'total_processed': len(results),
+            'results': results
+        })
+    
+    job_id = submit_job(job_store, image_paths, options={
+        'encoding': encoding, 'multi_face': multi_face, 'sampling': sampling})
     return jsonify({
-        'total_processed': len(results),
-        'results': results
-    })
+        'job_id': job_id,
+        'total': len(image_paths),
+        'status_url': url_for('job_status', job_id=job_id),
+        'events_url': url_for('job_events', job_id=job_id)
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report a job's progress and the results finished so far"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    job.pop('owner')
+    job['total_processed'] = len(job['results'])
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream each image's result as a Server-Sent Event as soon as it finishes"""
+    if job_store.get(job_id, include_results=False) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return event_stream_response(job_id)
+
+def event_stream_response(job_id):
+    # Resume after the last result a reconnecting client saw
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    start = 0 if last_id is None else last_id + 1
+    return Response(iter_job_events(job_store, job_id, start), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Stop a job after the image it is currently processing"""
+    if job_store.get(job_id, include_results=False) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if not job_store.request_cancel(job_id):
+        return jsonify({'error': 'Job already finished'}), 409
+    return jsonify({'message': 'Cancellation requested', 'job_id': job_id})
 
 @app.route('/download/<filename>')
 def download_file(filename):
     return send_from_directory(app.config['OUTPUT_FOLDER'], filename)
 
+def zip_response(file_paths, archive_name):
+    """Stream a stored ZIP of ``file_paths`` without building it first"""
+    return Response(iter_zip(file_paths), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{archive_name}"'
+    })
+
+@app.route('/download_zip')
+def download_zip():
+    """Download every cropped image as one ZIP"""
+    output_folder = app.config['OUTPUT_FOLDER']
+    file_paths = [os.path.join(output_folder, f) for f in sorted(os.listdir(output_folder))]
+    return zip_response(file_paths, 'cropped_images.zip')
+
+@app.route('/jobs/<job_id>/download')
+def download_job_zip(job_id):
+    """Download a job's cropped images (finished so far) as one ZIP"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    file_paths = [crop['output'] for r in job['results'] if r['success']
+                  for crop in r.get('faces') or r.get('frames') or [r]]
+    return zip_response(file_paths, f'cropped_{job_id}.zip')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics merged across all worker processes"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/status')
 def status():
-    upload_count = len(os.listdir(app.config['UPLOAD_FOLDER']))
+    upload_count = len([f for f in os.listdir(app.config['UPLOAD_FOLDER']) if not f.startswith('.')])
     output_count = len(os.listdir(app.config['OUTPUT_FOLDER']))
     
     return jsonify({
@@ -264,5 +361,7 @@ def status():
         'cropped_images': output_count
     })
 
+worker_startup.app_imported()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
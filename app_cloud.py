@@ -1,19 +1,29 @@
+import worker_startup  # First, so its clock covers the imports below
 import os
-import cv2
-import numpy as np
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for
+from collections import deque
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, session, redirect, url_for
 from werkzeug.utils import secure_filename
-import mediapipe as mp
-from PIL import Image
-import json
-import threading
+from batch import iter_process_images
+from chunked_upload import ChunkedUploadStore
+from content_store import ContentStore, touch
+from image_probe import ImageRejected, probe_buffer, remove_probe, save_probe
+from session_store import PROCESSED, UPLOAD, SessionStore
+from config import DETECTION_RETENTION_DAYS, DETECTION_STORE, MULTI_FACE
+from frame_source import frame_sampling_options, is_video
+from cropper import CROP_PARAMETERS, DETECTION_PARAMETERS
+from detection_store import get_detection_store
+from janitor import Janitor, evict_lru, disk_usage, remove_stale
+from jobs import JobStore, iter_job_events, start_job_runner, submit_job
+import metrics
+from output_encoding import encoding_options, output_extension
+from upload_stream import iter_file_parts, multipart_boundary
+from zip_stream import iter_zip
 import time
 import uuid
-import base64
-from datetime import datetime, timedelta
-import tempfile
+from datetime import datetime
 
 app = Flask(__name__)
+worker_startup.track_first_request(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this')
 
 # Configuration
@@ -21,19 +31,36 @@ app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
 app.config['UPLOAD_FOLDER'] = 'temp_uploads'  # Temporary storage
 app.config['OUTPUT_FOLDER'] = 'temp_outputs'  # Temporary storage
 app.config['SESSION_TIMEOUT'] = 3600  # 1 hour session timeout
+app.config['JOB_DATABASE'] = 'jobs.db'  # Job progress shared by all workers
+app.config['JOB_RETENTION'] = 24 * 3600  # Seconds finished jobs and their results are kept
+app.config['SESSION_DATABASE'] = 'sessions.db'  # Sessions and file ownership shared by all workers
+app.config['PARTIAL_UPLOAD_FOLDER'] = os.path.join('temp_uploads', '.partial')  # Resumable uploads in progress
+app.config['MAX_CHUNKED_UPLOAD_SIZE'] = app.config['MAX_CONTENT_LENGTH']  # Largest size a resumable upload may declare
+app.config['STORAGE_QUOTA_BYTES'] = int(os.environ.get('STORAGE_QUOTA_BYTES', 1024 * 1024 * 1024))  # temp_uploads + temp_outputs
+app.config['JANITOR_INTERVAL'] = 60  # Seconds between background cleanup sweeps
+app.config['EVICTION_GRACE_PERIOD'] = 600  # Never evict files used this recently
+app.config['JANITOR_LOCK'] = 'janitor.lock'  # Lets one worker sweep at a time
+app.config['KEEP_STREAMED_UPLOADS'] = False  # /upload_and_process: also store still images in temp_uploads
 
 # Create temporary directories
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
-# Initialize MediaPipe
-mp_face_detection = mp.solutions.face_detection
+# Background /process jobs, visible from every gunicorn worker
+job_store = JobStore(app.config['JOB_DATABASE'])
+
+# Uploads stored once per unique content; outputs cached per content and crop parameters
+content_store = ContentStore(app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'])
+
+# Resumable chunked uploads, streamed next to their final location
+chunked_uploads = ChunkedUploadStore(app.config['PARTIAL_UPLOAD_FOLDER'],
+                                     on_complete=content_store.put_file)
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'mp4', 'mov', 'avi', 'mkv', 'webm'}
 
-# Store user sessions and their files (in production, use Redis or database)
-user_sessions = {}
+# User sessions and the files they own, shared by every gunicorn worker
+session_store = SessionStore(app.config['SESSION_DATABASE'], app.config['SESSION_TIMEOUT'])
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -43,163 +70,92 @@ def get_user_session():
     if 'user_id' not in session:
         session['user_id'] = str(uuid.uuid4())
         session['created_at'] = datetime.now().isoformat()
-        user_sessions[session['user_id']] = {
-            'uploads': [],
-            'processed': [],
-            'created_at': datetime.now()
-        }
+    session_store.ensure(session['user_id'])
     return session['user_id']
 
+def remove_session(user_id):
+    """Delete a session and the files no other session still uses
+
+    Uploads and outputs are shared between sessions with identical content.
+    """
+    for kind, file_path in session_store.delete(user_id):
+        if kind == PROCESSED:
+            content_store.remove_output(file_path)
+        else:
+            remove_probe(file_path)
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            except:
+                pass
+
 def cleanup_old_sessions():
     """Clean up old sessions and temporary files"""
-    current_time = datetime.now()
-    expired_sessions = []
-    
-    for user_id, user_data in user_sessions.items():
-        if current_time - user_data['created_at'] > timedelta(hours=1):
-            expired_sessions.append(user_id)
-            # Clean up user files
-            for file_path in user_data['uploads'] + user_data['processed']:
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except:
-                    pass
-    
-    for user_id in expired_sessions:
-        del user_sessions[user_id]
+    for user_id in session_store.expired():
+        remove_session(user_id)
+    # Abandoned resumable uploads
+    remove_stale(app.config['PARTIAL_UPLOAD_FOLDER'], app.config['SESSION_TIMEOUT'])
 
-def detect_face_and_tie(image_path):
-    """Detect face and tie area using AI for ID card style cropping"""
+def evict_file(file_path):
+    """Delete a stored file for quota eviction; sessions lose their claim on it"""
+    session_store.forget(file_path)
+    if file_path.startswith(app.config['OUTPUT_FOLDER'] + os.sep):
+        return content_store.remove_output(file_path)
+    remove_probe(file_path)
     try:
-        # Read image
-        image = cv2.imread(image_path)
-        if image is None:
-            return None, "Could not read image"
-        
-        # Convert to RGB for MediaPipe
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Initialize face detection
-        with mp_face_detection.FaceDetection(
-            model_selection=1, min_detection_confidence=0.5) as face_detection:
-            
-            results = face_detection.process(rgb_image)
-            
-            if results.detections:
-                # Get the first detected face
-                detection = results.detections[0]
-                bbox = detection.location_data.relative_bounding_box
-                
-                h, w, _ = image.shape
-                x = int(bbox.xmin * w)
-                y = int(bbox.ymin * h)
-                width = int(bbox.width * w)
-                height = int(bbox.height * h)
-                
-                # Expand the crop area to include tie knot area
-                expanded_height = int(height * 2.5)
-                expanded_width = int(width * 1.8)
-                
-                # Adjust coordinates to stay within image bounds
-                start_x = max(0, x - (expanded_width - width) // 2)
-                start_y = max(0, y - (expanded_height - height) // 2)
-                end_x = min(w, start_x + expanded_width)
-                end_y = min(h, start_y + expanded_height)
-                
-                # Ensure minimum dimensions
-                if end_x - start_x < 200:
-                    center_x = (start_x + end_x) // 2
-                    start_x = max(0, center_x - 100)
-                    end_x = min(w, center_x + 100)
-                
-                if end_y - start_y < 300:
-                    center_y = (start_y + end_y) // 2
-                    start_y = max(0, center_y - 150)
-                    end_y = min(h, center_y + 150)
-                
-                return {
-                    'x': start_x,
-                    'y': start_y,
-                    'width': end_x - start_x,
-                    'height': end_y - start_y
-                }, None
-            else:
-                # Fallback: use center crop if no face detected
-                h, w, _ = image.shape
-                center_x, center_y = w // 2, h // 2
-                crop_size = min(w, h) // 2
-                
-                return {
-                    'x': max(0, center_x - crop_size // 2),
-                    'y': max(0, center_y - crop_size // 2),
-                    'width': min(crop_size, w),
-                    'height': min(crop_size, h)
-                }, "No face detected, using center crop"
-                
-    except Exception as e:
-        return None, str(e)
+        size = os.path.getsize(file_path)
+        os.remove(file_path)
+        return size
+    except OSError:
+        return 0
 
-def crop_image(image_path, crop_coords, output_path):
-    """Crop image based on detected coordinates and maintain 1:1.285 aspect ratio"""
-    try:
-        image = cv2.imread(image_path)
-        if image is None:
-            return False, "Could not read image"
-        
-        # First crop the image based on detected coordinates
-        cropped = image[
-            crop_coords['y']:crop_coords['y'] + crop_coords['height'],
-            crop_coords['x']:crop_coords['x'] + crop_coords['width']
-        ]
-        
-        # Now resize to maintain 1:1.285 aspect ratio
-        target_ratio = 1.0 / 1.285  # width/height ratio
-        
-        h, w = cropped.shape[:2]
-        current_ratio = w / h
-        
-        if current_ratio > target_ratio:
-            # Image is too wide, need to reduce width
-            new_width = int(h * target_ratio)
-            new_height = h
-            # Center crop horizontally
-            start_x = (w - new_width) // 2
-            cropped = cropped[:, start_x:start_x + new_width]
-        elif current_ratio < target_ratio:
-            # Image is too tall, need to reduce height
-            new_width = w
-            new_height = int(w / target_ratio)
-            # Center crop vertically
-            start_y = (h - new_height) // 2
-            cropped = cropped[start_y:start_y + new_height, :]
-        
-        # Save cropped image
-        cv2.imwrite(output_path, cropped)
-        return True, "Success"
-        
-    except Exception as e:
-        return False, str(e)
+def enforce_storage_quota():
+    """Evict least recently used outputs, then uploads, until under quota"""
+    usage = disk_usage([app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER']])
+    if usage <= app.config['STORAGE_QUOTA_BYTES']:
+        return
+    # Outputs can be recreated from their uploads, so they go first
+    freed = evict_lru([(content_store.outputs(), evict_file),
+                       (content_store.uploads(), evict_file)],
+                      usage, app.config['STORAGE_QUOTA_BYTES'],
+                      app.config['EVICTION_GRACE_PERIOD'])
+    print(f"Storage quota exceeded: evicted {freed} of {usage} bytes")
+
+def janitor_sweep():
+    cleanup_old_sessions()
+    enforce_storage_quota()
+    job_store.prune(app.config['JOB_RETENTION'])
+    detections = get_detection_store(DETECTION_STORE, DETECTION_PARAMETERS)
+    if detections is not None:
+        detections.prune(DETECTION_RETENTION_DAYS * 24 * 3600)
+
+# Session expiry and quota eviction off the request path, one worker at a time
+janitor = Janitor(janitor_sweep, app.config['JANITOR_INTERVAL'], app.config['JANITOR_LOCK'])
+
+@app.before_request
+def start_janitor():
+    janitor.ensure_started()
+
+@app.before_request
+def resume_jobs():
+    # Also picks up jobs left unfinished by a recycled or crashed worker
+    start_job_runner()
 
 @app.route('/')
 def index():
     """Main page with session management"""
     user_id = get_user_session()
-    cleanup_old_sessions()
     
     # Get user's files
-    user_data = user_sessions.get(user_id, {'uploads': [], 'processed': []})
-    
     return render_template('index_cloud.html', 
-                         uploads=user_data['uploads'],
-                         processed=user_data['processed'])
+                         uploads=session_store.files(user_id, UPLOAD),
+                         processed=session_store.files(user_id, PROCESSED))
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
     """Handle file uploads with user session management"""
     try:
         user_id = get_user_session()
-        user_data = user_sessions[user_id]
         
         if 'files[]' not in request.files:
             return jsonify({'error': 'No files selected'}), 400
@@ -210,136 +166,417 @@ def upload_files():
             return jsonify({'error': 'No files selected'}), 400
         
         uploaded_files = []
+        rejected_files = []
         for file in files:
             if file and allowed_file(file.filename):
-                # Create unique filename
-                filename = secure_filename(file.filename)
-                unique_filename = f"{user_id}_{int(time.time())}_{filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+                # Store by content hash; identical bytes are kept once
+                ext = os.path.splitext(secure_filename(file.filename))[1]
+                filepath = content_store.put_stream(file.stream, ext)
+                metrics.inc('crop_upload_bytes_total', os.path.getsize(filepath))
                 
-                file.save(filepath)
+                # Check dimensions from the header before anything decodes it
+                try:
+                    save_probe(filepath)
+                except ImageRejected as e:
+                    rejected_files.append({'file': file.filename, 'error': str(e)})
+                    continue
                 uploaded_files.append(filepath)
                 
                 # Add to user's upload list
-                user_data['uploads'].append(filepath)
+                session_store.add_file(user_id, UPLOAD, filepath)
         
+        if rejected_files and not uploaded_files:
+            return jsonify({'error': 'No acceptable images', 'rejected': rejected_files}), 400
         return jsonify({
             'message': f'{len(uploaded_files)} files uploaded successfully',
-            'files': [os.path.basename(f) for f in uploaded_files]
+            'files': [os.path.basename(f) for f in uploaded_files],
+            'rejected': rejected_files
         })
         
     except Exception as e:
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
+@app.route('/upload/chunked', methods=['POST'])
+def start_chunked_upload():
+    """Open a resumable upload; the body is JSON with the file's name and size in bytes"""
+    user_id = get_user_session()
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    size = data.get('size')
+    
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'Invalid file size'}), 400
+    if size > app.config['MAX_CHUNKED_UPLOAD_SIZE']:
+        return jsonify({'error': 'File too large'}), 413
+    
+    # Create unique filename
+    unique_filename = f"{user_id}_{int(time.time())}_{secure_filename(filename)}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    upload_id = chunked_uploads.create(filepath, size, owner=user_id)
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'size': size}), 201
+
+def get_user_upload(upload_id):
+    """Return the chunked upload if it belongs to the current user, else None"""
+    upload = chunked_uploads.get(upload_id)
+    if upload is None or upload['owner'] != get_user_session():
+        return None
+    return upload
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Report the acknowledged offset so a client can resume"""
+    upload = get_user_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found or access denied'}), 404
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': upload['offset'],
+        'size': upload['size'],
+        'complete': upload['complete'],
+        'file': os.path.basename(upload['final_path']) if upload['complete'] else None
+    })
+
+@app.route('/upload/chunked/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Stream one chunk, starting at the Upload-Offset header, straight to disk"""
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    
+    upload = get_user_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found or access denied'}), 404
+    
+    new_offset, error = chunked_uploads.write_chunk(upload_id, offset, request.stream)
+    if new_offset is not None and not error:
+        metrics.inc('crop_upload_bytes_total', new_offset - offset)
+    if error:
+        return jsonify({'error': error, 'offset': new_offset}), 409
+    
+    complete = new_offset == upload['size']
+    if complete:
+        # Stored by content hash once the last chunk landed
+        upload = chunked_uploads.get(upload_id)
+        try:
+            save_probe(upload['final_path'])
+        except ImageRejected as e:
+            return jsonify({'error': str(e)}), 400
+        # Add to user's upload list
+        session_store.add_file(upload['owner'], UPLOAD, upload['final_path'])
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': new_offset,
+        'complete': complete,
+        'file': os.path.basename(upload['final_path']) if complete else None
+    })
+
+def crop_params(encoding, multi_face=False, sampling=None):
+    """Everything that affects an output, for naming cached results"""
+    return dict(CROP_PARAMETERS, encoding=encoding, multi_face=multi_face, sampling=sampling)
+
+def process_image_batch(image_paths, user_id, encoding, multi_face=False, sampling=None):
+    """Crop the user's uploads on the batch engine, yielding result entries in input order
+
+    Outputs are cached by content hash, crop parameters and encoding, so
+    repeated content is cropped once and concurrent requests share the work.
+    In multi-face mode each entry also lists its faces, and videos and
+    multi-frame images list their cropped frames; "output" and "crop_coords"
+    then describe the first crop.
+    """
+    params = crop_params(encoding, multi_face, sampling)
+    items = [(os.path.basename(image_path), image_path, content_store.output_path(
+                 image_path, params, output_extension(image_path, encoding)))
+             for image_path in image_paths]
+    return crop_results(items, user_id, encoding, multi_face, sampling)
+
+def crop_results(items, user_id, encoding, multi_face=False, sampling=None):
+    """Result entries for ``(name, source, output_path)`` items, in input order
+
+    ``source`` is an upload path or the encoded bytes of a still image.
+    ``items`` is read lazily, as the batch engine has room for more work.
+    """
+    names = deque()
+    
+    def tasks():
+        for name, source, output_path in items:
+            names.append((name, output_path))
+            yield source, output_path
+    
+    for success, message, crop_coords in iter_process_images(
+            tasks(), store=content_store, encoding=encoding,
+            multi_face=multi_face, sampling=sampling):
+        name, output_path = names.popleft()
+        if success and isinstance(crop_coords, list):
+            crops = [dict(crop, output=os.path.basename(crop['output'])) for crop in crop_coords]
+            for crop in crop_coords:
+                session_store.add_file(user_id, PROCESSED, crop['output'])
+            yield {
+                'input': name,
+                'output': crops[0]['output'],
+                'success': success,
+                'message': message,
+                'crop_coords': crops[0]['crop_coords'],
+                'frames' if 'frame' in crops[0] else 'faces': crops
+            }
+            continue
+        
+        if success:
+            # Add to user's processed list
+            session_store.add_file(user_id, PROCESSED, output_path)
+        
+        yield {
+            'input': name,
+            'output': os.path.basename(output_path) if success else None,
+            'success': success,
+            'message': message,
+            'crop_coords': crop_coords if success else None
+        }
+
+@job_store.runner
+def run_crop_job(image_paths, user_id, options):
+    """A background /process job's work; whichever worker claims the job runs it"""
+    return process_image_batch(image_paths, user_id, options['encoding'], options['multi_face'],
+                               options['sampling'])
+
 @app.route('/process', methods=['POST'])
 def process_images():
-    """Process images with user session management"""
+    """Start a background crop job; pass "wait": true for the old blocking response
+
+    Follow the job at "status_url", or stream its results as they finish
+    from "events_url" (Server-Sent Events).
+
+    Optional "format", "quality", "progressive" and "target_kb" fields
+    override the output encoding settings in config.py; "multi_face": true
+    crops every detected face. "frame_step", "sharpest_frame" and
+    "max_frames" choose the frames cropped from videos and multi-frame images.
+    """
     data = request.get_json()
     image_paths = data.get('image_paths', [])
     
     if not image_paths:
         return jsonify({'error': 'No images to process'}), 400
     
+    try:
+        encoding = encoding_options(data.get('format'), data.get('quality'),
+                                    data.get('progressive'), data.get('target_kb'),
+                                    data.get('size'))
+        sampling = frame_sampling_options(data.get('frame_step'), data.get('sharpest_frame'),
+                                          data.get('max_frames'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    multi_face = bool(data.get('multi_face', MULTI_FACE))
     user_id = get_user_session()
-    user_data = user_sessions[user_id]
     
-    results = []
+    # Verify files belong to user
+    image_paths = [p for p in image_paths if session_store.owns(user_id, UPLOAD, p)]
     
-    for image_path in image_paths:
-        try:
-            # Verify file belongs to user
-            if image_path not in user_data['uploads']:
+    if data.get('wait'):
+        results = list(process_image_batch(image_paths, user_id, encoding, multi_face, sampling))
+        return jsonify({
+            'total_processed': len(results),
+            'results': results
+        })
+    
+    job_id = submit_job(job_store, image_paths, owner=user_id, options={
+        'encoding': encoding, 'multi_face': multi_face, 'sampling': sampling})
+    return jsonify({
+        'job_id': job_id,
+        'total': len(image_paths),
+        'status_url': url_for('job_status', job_id=job_id),
+        'events_url': url_for('job_events', job_id=job_id)
+    }), 202
+
+def bool_arg(name, default=None):
+    """Boolean query-string option (true/false, 1/0, yes/no, on/off)"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+@app.route('/upload_and_process', methods=['POST'])
+def upload_and_process():
+    """Upload and crop in one request, cropping each file while later ones upload
+
+    The multipart body ("files[]" parts) is parsed as it arrives. Still
+    images are decoded in memory and queued for cropping as soon as their
+    last byte is in; they are stored in temp_uploads only with "keep=true"
+    (or KEEP_STREAMED_UPLOADS). Videos and multi-frame images are stored,
+    since they are read back frame by frame. Options are query-string
+    versions of the /process fields. Returns the /process "wait" response,
+    with "input" set to each file's uploaded name.
+    """
+    user_id = get_user_session()
+    try:
+        encoding = encoding_options(request.args.get('format'), request.args.get('quality', type=int),
+                                    bool_arg('progressive'), request.args.get('target_kb', type=int),
+                                    request.args.get('size'))
+        sampling = frame_sampling_options(request.args.get('frame_step', type=int),
+                                          bool_arg('sharpest_frame'),
+                                          request.args.get('max_frames', type=int))
+        boundary = multipart_boundary(request.content_type)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    multi_face = bool_arg('multi_face', MULTI_FACE)
+    keep = bool_arg('keep', app.config['KEEP_STREAMED_UPLOADS'])
+    params = crop_params(encoding, multi_face, sampling)
+    rejected_files = []
+    
+    def store(data, ext):
+        filepath = content_store.put_bytes(data, ext)
+        save_probe(filepath)
+        session_store.add_file(user_id, UPLOAD, filepath)
+        return filepath
+    
+    def items():
+        for filename, data in iter_file_parts(request.stream, boundary):
+            if not allowed_file(filename):
+                rejected_files.append({'file': filename, 'error': 'File type not allowed'})
                 continue
-                
-            # Detect face and tie area
-            crop_coords, message = detect_face_and_tie(image_path)
-            
-            if crop_coords:
-                # Generate output filename
-                filename = os.path.basename(image_path)
-                name, ext = os.path.splitext(filename)
-                output_filename = f"{name}_cropped{ext}"
-                output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-                
-                # Crop the image
-                success, crop_message = crop_image(image_path, crop_coords, output_path)
-                
-                if success:
-                    # Add to user's processed list
-                    user_data['processed'].append(output_path)
-                
-                results.append({
-                    'input': os.path.basename(image_path),
-                    'output': os.path.basename(output_path) if success else None,
-                    'success': success,
-                    'message': crop_message or message
-                })
-            else:
-                results.append({
-                    'input': os.path.basename(image_path),
-                    'output': None,
-                    'success': False,
-                    'message': message
-                })
-                
-        except Exception as e:
-            results.append({
-                'input': os.path.basename(image_path),
-                'output': None,
-                'success': False,
-                'message': str(e)
-            })
+            metrics.inc('crop_upload_bytes_total', len(data))
+            ext = os.path.splitext(secure_filename(filename))[1]
+            try:
+                if is_video(filename):
+                    source = store(data, ext)
+                else:
+                    # Header check before anything decodes it
+                    probe = probe_buffer(data)
+                    source = store(data, ext) if keep or probe['frames'] > 1 else data
+            except ImageRejected as e:
+                rejected_files.append({'file': filename, 'error': str(e)})
+                continue
+            output_path = content_store.output_path(
+                content_store.bytes_path(data, ext), params, output_extension(filename, encoding))
+            yield filename, source, output_path
     
+    results = list(crop_results(items(), user_id, encoding, multi_face, sampling))
+    if not results and not rejected_files:
+        return jsonify({'error': 'No files selected'}), 400
+    if not results:
+        return jsonify({'error': 'No acceptable images', 'rejected': rejected_files}), 400
     return jsonify({
         'total_processed': len(results),
-        'results': results
+        'results': results,
+        'rejected': rejected_files
     })
 
+def get_user_job(job_id, include_results=True):
+    """Return the job if it belongs to the current user, else None"""
+    job = job_store.get(job_id, include_results=include_results)
+    if job is None or job.pop('owner') != get_user_session():
+        return None
+    return job
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report a job's progress and the results finished so far"""
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    job['total_processed'] = len(job['results'])
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream each image's result as a Server-Sent Event as soon as it finishes"""
+    if get_user_job(job_id, include_results=False) is None:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    return event_stream_response(job_id)
+
+def event_stream_response(job_id):
+    # Resume after the last result a reconnecting client saw
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    start = 0 if last_id is None else last_id + 1
+    return Response(iter_job_events(job_store, job_id, start), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Stop a job after the image it is currently processing"""
+    if get_user_job(job_id, include_results=False) is None:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    if not job_store.request_cancel(job_id):
+        return jsonify({'error': 'Job already finished'}), 409
+    return jsonify({'message': 'Cancellation requested', 'job_id': job_id})
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """Download processed file with user verification"""
     user_id = get_user_session()
-    user_data = user_sessions.get(user_id, {'processed': []})
     
     # Check if file belongs to user
     file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-    if file_path in user_data['processed']:
+    if session_store.owns(user_id, PROCESSED, file_path):
+        touch(file_path)
         return send_from_directory(app.config['OUTPUT_FOLDER'], filename)
     else:
         return jsonify({'error': 'File not found or access denied'}), 404
 
+def zip_response(file_paths, archive_name):
+    """Stream a stored ZIP of ``file_paths`` without building it first"""
+    return Response(iter_zip(file_paths), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{archive_name}"'
+    })
+
+@app.route('/download_zip')
+def download_zip():
+    """Download all of the user's processed images as one ZIP"""
+    user_id = get_user_session()
+    
+    return zip_response(session_store.files(user_id, PROCESSED), 'cropped_images.zip')
+
+@app.route('/jobs/<job_id>/download')
+def download_job_zip(job_id):
+    """Download a job's processed images (finished so far) as one ZIP"""
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    user_id = get_user_session()
+    file_paths = [os.path.join(app.config['OUTPUT_FOLDER'], crop['output'])
+                  for r in job['results'] if r['success']
+                  for crop in r.get('faces') or r.get('frames') or [r]]
+    
+    # Check files belong to user
+    file_paths = [p for p in file_paths if session_store.owns(user_id, PROCESSED, p)]
+    return zip_response(file_paths, f'cropped_{job_id}.zip')
+
 @app.route('/clear_session', methods=['POST'])
 def clear_session():
     """Clear user session and files"""
     user_id = get_user_session()
-    user_data = user_sessions.get(user_id, {})
-    
-    # Remove user files
-    for file_path in user_data.get('uploads', []) + user_data.get('processed', []):
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except:
-            pass
     
-    # Clear session
+    # Clear session, then remove user files no other session shares
     session.clear()
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    remove_session(user_id)
     
     return jsonify({'message': 'Session cleared successfully'})
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics merged across all worker processes"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/status')
 def status():
     """Get user's file status"""
     user_id = get_user_session()
-    user_data = user_sessions.get(user_id, {'uploads': [], 'processed': []})
     
     return jsonify({
-        'uploaded_files': len(user_data['uploads']),
-        'processed_images': len(user_data['processed']),
+        'uploaded_files': session_store.count(user_id, UPLOAD),
+        'processed_images': session_store.count(user_id, PROCESSED),
         'session_id': user_id
     })
 
+worker_startup.app_imported()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
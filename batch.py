@@ -0,0 +1,240 @@
+"""Parallel batch engine for /process.
+
+Decode, detection, crop and encode for each image run in a pool of worker
+processes so one bulk request can use every core. At most
+PROCESSING_WORKERS * MAX_IN_FLIGHT_PER_WORKER images are in flight at once,
+and results come back in input order as soon as each one is ready.
+
+Images are also admitted against PROCESSING_MEMORY_BUDGET_MB, using the
+decoded size from each image's header probe (see image_probe.py): an image
+waits until enough in-flight images have finished. The budget covers every
+batch running in the web worker (background jobs, "wait" requests and
+upload-and-crop requests share one pool). Images over MAX_IMAGE_MEGAPIXELS
+fail without being decoded.
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from config import (DETECTION_STORE, MAX_IN_FLIGHT_PER_WORKER, PROCESSING_MEMORY_BUDGET_MB,
+                    PROCESSING_WORKERS)
+import metrics
+from cropper import DETECTION_PARAMETERS, process_frames, process_image, process_image_faces
+from detection_store import get_detection_store
+from face_detector import warm_face_detector
+from image_probe import ImageRejected, load_probe, probe_buffer
+from jobs import run_on_job_thread
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_budget_freed = threading.Condition(_pool_lock)
+_in_flight_bytes = 0  # Decoded bytes admitted to the pool by all batches in this process
+
+
+def worker_count(workers=PROCESSING_WORKERS):
+    """Resolve the configured worker count (0 = this process's share of the CPU cores)
+
+    Every gunicorn worker runs its own pool, so the cores are split between
+    the WEB_CONCURRENCY web workers (exported by gunicorn.conf.py, unset for
+    bulk_crop.py and the development server).
+    """
+    if workers > 0:
+        return workers
+    web_workers = max(1, int(os.environ.get('WEB_CONCURRENCY') or 1))
+    return max(1, (os.cpu_count() or 1) // web_workers)
+
+def _process_task(task, store=None, encoding=None, multi_face=False, sampling=None,
+                  detection_db=None, recrop=False):
+    """Run in a pool process: crop and encode one (image_path, output_path) task
+
+    The image may also be given as encoded bytes (a still image streamed in
+    by upload_stream.py), which are decoded in memory. With a ContentStore,
+    an output that already exists is reused and concurrent requests for the
+    same output share one computation. In multi-face mode, and for videos
+    and multi-frame images, the result's third item is a list of crops, each
+    with its own ``output`` path. Detections are saved to and reused from
+    the SQLite file ``detection_db``.
+    """
+    image_path, output_path = task
+    try:
+        probe = _load_probe(image_path)
+    except ImageRejected as e:
+        metrics.inc('crop_images_total', result='rejected')
+        return False, str(e), None
+    if probe['frames'] > 1 or probe['format'] == 'video':
+        def process(image_path, output_path, encoding):
+            return process_frames(image_path, output_path, encoding, multi_face, sampling)
+    else:
+        still = process_image_faces if multi_face else process_image
+        detections = get_detection_store(detection_db, DETECTION_PARAMETERS)
+        # Content-store uploads are named by their hash, so it need not be computed again
+        content_key = store.upload_hash(image_path) if store is not None else None
+
+        def process(image_path, output_path, encoding):
+            return still(image_path, output_path, encoding, detections, recrop, content_key)
+    try:
+        if store is not None:
+            return store.process_once(
+                output_path, lambda: process(image_path, output_path, encoding))
+        return process(image_path, output_path, encoding)
+    except Exception as e:
+        return False, str(e), None
+
+def _load_probe(image):
+    return probe_buffer(image) if isinstance(image, bytes) else load_probe(image)
+
+def _task_cost(task):
+    """Decoded bytes one task will allocate (0 if it will be rejected)"""
+    try:
+        return _load_probe(task[0])['decoded_bytes']
+    except (ImageRejected, KeyError):
+        return 0
+
+def _reserve(cost, budget, wait):
+    """Admit ``cost`` decoded bytes against the process-wide memory budget.
+
+    Returns False if they do not fit, or with ``wait`` blocks until enough
+    in-flight images (of any batch) have finished. An image larger than the
+    whole budget is admitted once nothing else is in flight.
+    """
+    global _in_flight_bytes
+    with _budget_freed:
+        while budget and _in_flight_bytes and _in_flight_bytes + cost > budget:
+            if not wait:
+                return False
+            _budget_freed.wait()
+        _in_flight_bytes += cost
+    metrics.add_gauge('crop_in_flight_bytes', cost)
+    return True
+
+def _release(cost):
+    global _in_flight_bytes
+    with _budget_freed:
+        _in_flight_bytes -= cost
+        _budget_freed.notify_all()
+    metrics.add_gauge('crop_in_flight_bytes', -cost)
+
+def _init_pool_process():
+    try:
+        warm_face_detector()
+    except Exception:
+        pass  # A broken initializer would fail every task; images report the error instead
+
+def _get_pool(workers):
+    """One process pool per web worker, reused across batches"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn rather than fork: the web worker has threads and MediaPipe state.
+            # Each pool process warms its detector as it starts.
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_pool_process)
+            _pool_pid = os.getpid()
+        return _pool
+
+def warm_up_detectors(workers=PROCESSING_WORKERS):
+    """Start the detectors crops will use, ahead of the first batch
+
+    Inline (one worker), crops run on the thread reading the batch, and
+    detectors are per thread: background jobs run on the job runner thread,
+    so that thread's detector is warmed. Otherwise the pool processes are
+    started without waiting for them; each one warms its own detector as it
+    starts.
+    """
+    workers = worker_count(workers)
+    if workers == 1:
+        run_on_job_thread(warm_face_detector).result()
+        return
+    pool = _get_pool(workers)
+    # The pool starts a process per task submitted while none is idle
+    for _ in range(workers):
+        pool.submit(os.getpid)
+
+def iter_process_images(tasks, workers=PROCESSING_WORKERS,
+                        max_in_flight=MAX_IN_FLIGHT_PER_WORKER, store=None, encoding=None,
+                        memory_budget=PROCESSING_MEMORY_BUDGET_MB * 1024 * 1024,
+                        multi_face=False, sampling=None, detection_db=DETECTION_STORE,
+                        recrop=False):
+    """Yield ``(success, message, crop_coords)`` for each task, in input order.
+
+    ``tasks`` is an iterable of ``(image_path, output_path)`` pairs, read
+    only as capacity frees up, so it may be a generator still producing
+    tasks (e.g. from an upload in progress). With a single worker the
+    images are processed inline in the calling thread.
+    Closing the generator early cancels work that has not started yet.
+    ``store`` is an optional ContentStore used to cache outputs, and
+    ``encoding`` the output encoding options (config.py defaults if None).
+    ``memory_budget`` caps the decoded bytes in flight across every batch in
+    this process (0 = no limit); an image larger than the whole budget still
+    runs, but on its own. A batch with nothing in flight waits for others.
+    ``multi_face`` crops every detected face (see cropper.process_image_faces)
+    and ``sampling`` picks the frames of multi-frame inputs (see
+    frame_source.frame_sampling_options; config.py defaults if None).
+    ``detection_db`` is the detection store file (None = always detect), and
+    ``recrop`` crops from stored detections only (see cropper.process_image).
+    """
+    workers = worker_count(workers)
+    if workers == 1:
+        for task in tasks:
+            metrics.add_gauge('crop_in_flight_images', 1)
+            try:
+                result = _process_task(task, store, encoding, multi_face, sampling,
+                                       detection_db, recrop)
+            finally:
+                metrics.add_gauge('crop_in_flight_images', -1)
+            yield result
+        return
+
+    pool = _get_pool(workers)
+    limit = workers * max(1, max_in_flight)
+    tasks = iter(tasks)
+    pending = deque()  # Futures in input order
+    waiting = []       # Next (task, cost), read but not yet admitted
+
+    def admit():
+        while len(pending) < limit:
+            if not waiting:
+                task = next(tasks, None)
+                if task is None:
+                    return
+                waiting.append((task, _task_cost(task)))
+            task, cost = waiting[0]
+            # Wait for other batches only when this one has nothing of its own in flight
+            if not _reserve(cost, memory_budget, wait=not pending):
+                return
+            waiting.pop()
+            try:
+                future = pool.submit(_process_task, task, store, encoding, multi_face, sampling,
+                                     detection_db, recrop)
+            except BaseException:
+                _release(cost)
+                raise
+            # The memory is freed when the pool finishes (or a cancel drops) the image
+            future.add_done_callback(lambda _, cost=cost: _release(cost))
+            pending.append(future)
+            metrics.add_gauge('crop_in_flight_images', 1)
+
+    try:
+        admit()
+        while pending:
+            result = pending[0].result()
+            pending.popleft()
+            metrics.add_gauge('crop_in_flight_images', -1)
+            admit()
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        metrics.add_gauge('crop_in_flight_images', -len(pending))
+
+def shutdown_pool():
+    """Stop this web worker's process pool (called when gunicorn recycles it)"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and _pool_pid == os.getpid():
+        pool.shutdown(wait=False, cancel_futures=True)
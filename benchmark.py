@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Per-stage benchmark for the crop pipeline
+
+Generates synthetic portraits at several resolutions and formats, then times
+each pipeline stage separately (decode, proxy decode, colour conversion,
+detection, crop geometry, hair refinement, crop, encode) plus the end-to-end
+process_image call, and a re-crop from stored detections. Each case runs in
+a fresh process so its peak RSS is its own.
+
+Runs offline on a CPU-only machine.
+
+Usage:
+    python benchmark.py                                  # run and print a report
+    python benchmark.py --save-baseline bench.json       # record a baseline
+    python benchmark.py --compare bench.json             # flag regressions (exit 1)
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+# (label, width, height): 2 MP to 45 MP, camera-like 3:2 frames
+RESOLUTIONS = [
+    ('2MP', 1732, 1155),
+    ('12MP', 4242, 2828),
+    ('24MP', 6000, 4000),
+    ('45MP', 8256, 5504),
+]
+FORMATS = ['jpg', 'png']
+STAGES = ['decode', 'decode_proxy', 'color', 'detect', 'geometry', 'hair', 'crop', 'encode', 'total', 'recrop']
+DEFAULT_TOLERANCE = 0.15  # Allowed slowdown against the baseline before flagging
+
+
+def make_portrait(width, height, seed=0):
+    """Draw a simple head-and-shoulders portrait on a noisy studio background"""
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(170, 220, height, dtype=np.float32)[:, None, None]
+    image = np.broadcast_to(gradient, (height, width, 3)).copy()
+    image += rng.normal(0, 6, size=(height, width, 3)).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    cx, cy = width // 2, int(height * 0.38)
+    face_w, face_h = int(height * 0.11), int(height * 0.15)
+    # Shoulders and suit
+    cv2.ellipse(image, (cx, height), (int(face_w * 3.2), int(height * 0.42)), 0, 180, 360,
+                (60, 45, 40), -1)
+    # Shirt and tie
+    cv2.rectangle(image, (cx - face_w // 3, cy + face_h), (cx + face_w // 3, height),
+                  (235, 235, 235), -1)
+    cv2.rectangle(image, (cx - face_w // 10, cy + face_h), (cx + face_w // 10, height),
+                  (40, 40, 150), -1)
+    # Neck, face, hair
+    cv2.rectangle(image, (cx - face_w // 2, cy), (cx + face_w // 2, cy + int(face_h * 1.3)),
+                  (120, 160, 205), -1)
+    cv2.ellipse(image, (cx, cy), (face_w, face_h), 0, 0, 360, (130, 170, 215), -1)
+    cv2.ellipse(image, (cx, cy - face_h // 2), (face_w, face_h // 2), 0, 180, 360, (30, 30, 40), -1)
+    # Eyes and mouth
+    for dx in (-face_w // 2.5, face_w // 2.5):
+        cv2.circle(image, (int(cx + dx), cy - face_h // 8), max(2, face_w // 10), (50, 40, 30), -1)
+    cv2.ellipse(image, (cx, cy + face_h // 2), (face_w // 3, face_h // 10), 0, 0, 180,
+                (70, 70, 150), max(2, face_w // 25))
+    return image
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    # VmHWM is reset on exec, unlike ru_maxrss which a spawned child inherits
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+def time_call(fn, repeat):
+    """Median wall time of fn() in milliseconds, plus its last return value"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+def run_case(args):
+    """Benchmark one image file; runs in its own process"""
+    image_path, repeat = args
+    # Imported here so each case process loads its own detector
+    from cropper import (DETECTION_PARAMETERS, crop_to_aspect, load_detection_proxy,
+                         plan_center_crop, plan_face_crop, process_image, refine_hair_top)
+    from detection_store import DetectionStore
+    from face_detector import get_face_detector
+    from output_encoding import encode_image, encoding_options
+
+    timings = {}
+    detector = get_face_detector()
+    ext = os.path.splitext(image_path)[1]
+    output_path = os.path.join(os.path.dirname(image_path), 'out' + ext)
+
+    timings['decode'], image = time_call(lambda: cv2.imread(image_path), repeat)
+    timings['decode_proxy'], (proxy, (h, w)) = time_call(lambda: load_detection_proxy(image_path), repeat)
+    timings['color'], rgb = time_call(lambda: cv2.cvtColor(proxy, cv2.COLOR_BGR2RGB), repeat)
+    detector.process(rgb)  # Warm up the graph before timing it
+    timings['detect'], results = time_call(lambda: detector.process(rgb), repeat)
+
+    if results.detections:
+        bbox = results.detections[0].location_data.relative_bounding_box
+        timings['geometry'], crop_coords = time_call(lambda: plan_face_crop(bbox, h, w), repeat)
+        timings['hair'], crop_coords = time_call(
+            lambda: refine_hair_top(proxy, bbox, crop_coords, h, w), repeat)
+    else:
+        timings['geometry'], crop_coords = time_call(lambda: plan_center_crop(h, w), repeat)
+
+    timings['crop'], cropped = time_call(lambda: crop_to_aspect(image, crop_coords), repeat)
+    encoding = encoding_options()
+    timings['encode'], _ = time_call(lambda: encode_image(cropped, ext, encoding), repeat)
+    del image, cropped
+    timings['total'], _ = time_call(lambda: process_image(image_path, output_path), repeat)
+    detections = DetectionStore(os.path.join(os.path.dirname(image_path), 'detections.db'),
+                                DETECTION_PARAMETERS)
+    process_image(image_path, output_path, detections=detections)
+    timings['recrop'], _ = time_call(
+        lambda: process_image(image_path, output_path, detections=detections, recrop=True), repeat)
+
+    return {
+        'stages_ms': {stage: round(value, 3) for stage, value in timings.items()},
+        'images_per_second': round(1000.0 / timings['total'], 3) if timings['total'] else None,
+        'face_detected': bool(results.detections),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def generate_inputs(workdir, resolutions, formats):
+    """Write one synthetic portrait per (resolution, format); returns [(case, path)]"""
+    cases = []
+    for label, width, height in resolutions:
+        image = make_portrait(width, height)
+        for fmt in formats:
+            path = os.path.join(workdir, f'portrait_{label}.{fmt}')
+            params = [cv2.IMWRITE_JPEG_QUALITY, 92] if fmt == 'jpg' else []
+            cv2.imwrite(path, image, params)
+            cases.append((f'{label}-{fmt}', path))
+    return cases
+
+def compare(results, baseline, tolerance):
+    """Return regression messages for stages slower than baseline * (1 + tolerance)"""
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get('results', {}).get(case)
+        if base is None:
+            continue
+        for stage, value in result['stages_ms'].items():
+            base_value = base['stages_ms'].get(stage)
+            # Ignore sub-millisecond stages; their noise dwarfs any change
+            if base_value and max(value, base_value) >= 1.0 and value > base_value * (1 + tolerance):
+                regressions.append(f"{case} {stage}: {base_value:.2f} ms -> {value:.2f} ms "
+                                   f"(+{(value / base_value - 1) * 100:.0f}%)")
+    return regressions
+
+def print_report(results):
+    header = f"{'case':<12}" + ''.join(f"{stage:>13}" for stage in STAGES) + f"{'img/s':>9}{'RSS MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for case, result in results.items():
+        stages = result['stages_ms']
+        row = f"{case:<12}" + ''.join(f"{stages.get(stage, 0):>13.2f}" for stage in STAGES)
+        row += f"{result['images_per_second']:>9.2f}{result['peak_rss_mb']:>9.0f}"
+        print(row)
+    print("(stage times are medians in ms)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage benchmark for the crop pipeline")
+    parser.add_argument('--resolutions', nargs='+', default=[r[0] for r in RESOLUTIONS],
+                        choices=[r[0] for r in RESOLUTIONS], help="Resolutions to test")
+    parser.add_argument('--formats', nargs='+', default=FORMATS, choices=FORMATS,
+                        help="File formats to test")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per stage")
+    parser.add_argument('--save-baseline', metavar='FILE', help="Write results to a baseline file")
+    parser.add_argument('--compare', metavar='FILE', help="Compare results with a baseline file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown before a stage is flagged (0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    resolutions = [r for r in RESOLUTIONS if r[0] in args.resolutions]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='crop-bench-') as workdir:
+        print("Generating synthetic portraits...")
+        cases = generate_inputs(workdir, resolutions, args.formats)
+
+        # A fresh process per case keeps peak RSS figures independent
+        context = multiprocessing.get_context('spawn')
+        for case, path in cases:
+            with context.Pool(1) as pool:
+                results[case] = pool.apply(run_case, ((path, args.repeat),))
+            print(f"  {case}: {results[case]['images_per_second']:.2f} images/s")
+
+    print()
+    print_report(results)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        print()
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) against {args.compare}:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print(f"✅ No regressions against {args.compare}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
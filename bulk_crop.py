@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Headless batch cropper for local image folders
+
+Walks an input directory tree, crops every image with the same detection and
+crop logic as the web app, and writes the results to a mirrored tree under
+the output directory. No Flask server is involved.
+
+Usage:
+    python bulk_crop.py INPUT_DIR OUTPUT_DIR [--workers N] [--skip-existing]
+                        [--format webp] [--quality 85] [--target-kb 200]
+                        [--multi-face] [--frame-step 5] [--sharpest-frame]
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+from batch import iter_process_images, worker_count
+from config import (ALLOWED_EXTENSIONS, DETECTION_STORE, MULTI_FACE, OUTPUT_PREFIX,
+                    PROCESSING_WORKERS)
+from cropper import face_output_path, frame_output_path
+from frame_source import frame_sampling_options, is_video
+from image_probe import ImageRejected, load_probe
+from output_encoding import FORMAT_EXTENSIONS, encoding_options, output_extension
+
+
+def find_images(input_dir):
+    """Yield image paths under input_dir in a stable (sorted) order"""
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS:
+                yield os.path.join(root, filename)
+
+def get_output_path(image_path, input_dir, output_dir, encoding):
+    """Mirror image_path's location under output_dir, e.g. a/b.jpg -> out/a/b_cropped.jpg"""
+    relative_dir = os.path.relpath(os.path.dirname(image_path), input_dir)
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    ext = output_extension(image_path, encoding)
+    return os.path.normpath(os.path.join(output_dir, relative_dir, f"{name}{OUTPUT_PREFIX}{ext}"))
+
+def has_output(image_path, output_path, multi_face):
+    """Whether an earlier run already wrote output for image_path"""
+    pattern = glob.escape(output_path)
+    if is_video(image_path) or _frame_count(image_path) > 1:
+        # Sampled frames keep their own numbers, and the sharpest one can be any of them
+        pattern = frame_output_path(pattern, '*')
+    if multi_face:
+        pattern = face_output_path(pattern, 1)
+    return bool(glob.glob(pattern))
+
+def _frame_count(image_path):
+    try:
+        return load_probe(image_path)['frames']
+    except ImageRejected:
+        return 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crop every image in a folder tree to ID card style")
+    parser.add_argument('input_dir', help="Folder to read images from (searched recursively)")
+    parser.add_argument('output_dir', help="Folder to write cropped images to (tree is mirrored)")
+    parser.add_argument('--workers', type=int, default=PROCESSING_WORKERS,
+                        help="Crop worker processes (0 = one per CPU core, 1 = no pool)")
+    parser.add_argument('--skip-existing', action='store_true',
+                        help="Skip images whose output file already exists")
+    parser.add_argument('--report-every', type=int, default=100,
+                        help="Print progress every N images")
+    parser.add_argument('--format', choices=['original'] + list(FORMAT_EXTENSIONS),
+                        help="Output format (default from config.py)")
+    parser.add_argument('--quality', type=int, help="JPEG/WebP quality, 1-100")
+    parser.add_argument('--progressive', action=argparse.BooleanOptionalAction,
+                        help="Write progressive JPEGs")
+    parser.add_argument('--target-kb', type=int,
+                        help="Lower JPEG/WebP quality until each output fits this size (0 = off)")
+    parser.add_argument('--size', help="Resize each crop to exactly WIDTHxHEIGHT pixels, e.g. 413x531")
+    parser.add_argument('--multi-face', action=argparse.BooleanOptionalAction, default=MULTI_FACE,
+                        help="Write one crop per detected face (a_cropped_face1.jpg, ...)")
+    parser.add_argument('--frame-step', type=int,
+                        help="Crop every Nth frame of videos and multi-frame images")
+    parser.add_argument('--sharpest-frame', action=argparse.BooleanOptionalAction,
+                        help="Crop only the sharpest sampled frame")
+    parser.add_argument('--max-frames', type=int, help="Most frames sampled from one input")
+    parser.add_argument('--detections', default=DETECTION_STORE,
+                        help="SQLite file that saves face detections for reuse by --recrop "
+                             "(off unless given here or as DETECTION_STORE in config.py)")
+    parser.add_argument('--recrop', action='store_true',
+                        help="Rebuild crops from saved detections only, without running face "
+                             "detection (after changing crop settings; videos are detected again)")
+    args = parser.parse_args(argv)
+
+    try:
+        encoding = encoding_options(args.format, args.quality, args.progressive, args.target_kb,
+                                    args.size)
+        sampling = frame_sampling_options(args.frame_step, args.sharpest_frame, args.max_frames)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+
+    if args.recrop and not args.detections:
+        print("❌ --recrop needs the detection store the folder was cropped with "
+              "(--detections or DETECTION_STORE in config.py)")
+        return 1
+
+    if not os.path.isdir(args.input_dir):
+        print(f"❌ Input folder not found: {args.input_dir}")
+        return 1
+
+    tasks = []
+    created_dirs = set()
+    for image_path in find_images(args.input_dir):
+        output_path = get_output_path(image_path, args.input_dir, args.output_dir, encoding)
+        if args.skip_existing and has_output(image_path, output_path, args.multi_face):
+            continue
+        output_dir = os.path.dirname(output_path)
+        if output_dir not in created_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+            created_dirs.add(output_dir)
+        tasks.append((image_path, output_path))
+
+    total = len(tasks)
+    if total == 0:
+        print("No images to process")
+        return 0
+
+    print(f"Cropping {total} images with {worker_count(args.workers)} workers...")
+    start = time.time()
+    failed = 0
+    results = iter_process_images(tasks, workers=args.workers, encoding=encoding,
+                                  multi_face=args.multi_face, sampling=sampling,
+                                  detection_db=args.detections, recrop=args.recrop)
+    for done, ((image_path, output_path), (success, message, crop_coords)) in enumerate(
+            zip(tasks, results), 1):
+        if not success:
+            failed += 1
+            print(f"❌ {image_path}: {message}")
+
+        if done % args.report_every == 0 or done == total:
+            elapsed = time.time() - start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            remaining = (total - done) / rate if rate > 0 else 0.0
+            print(f"[{done}/{total}] {rate:.1f} images/s, {failed} failed, "
+                  f"ETA {remaining:.0f}s")
+
+    elapsed = time.time() - start
+    print(f"✅ Done: {total - failed} cropped, {failed} failed in {elapsed:.1f}s "
+          f"({total / elapsed:.1f} images/s)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Resumable chunked uploads that stream straight to disk.
+
+A client opens an upload with the file name and total size, then sends the
+bytes in any number of PATCH requests, each tagged with the offset it starts
+at. Chunks are copied from the request stream to a partial file next to the
+final location in fixed-size blocks, so memory stays bounded whatever the
+file size. The partial file's length is the acknowledged offset, which lets
+a client resume after a dropped connection and lets any worker continue an
+upload another worker started. The finished file is renamed into place.
+"""
+import json
+import os
+import shutil
+import uuid
+
+from content_store import lock_file
+
+COPY_BLOCK_SIZE = 1024 * 1024  # Bytes copied from the request stream at a time
+PARTIAL_SUFFIX = '.part'
+META_SUFFIX = '.json'
+
+
+class ChunkedUploadStore:
+    """Partial uploads kept in ``partial_folder`` until complete"""
+
+    def __init__(self, partial_folder, on_complete=None):
+        # on_complete(path) may move a finished file and return its new path
+        self.partial_folder = partial_folder
+        self.on_complete = on_complete
+        os.makedirs(partial_folder, exist_ok=True)
+
+    def _path(self, upload_id, suffix):
+        return os.path.join(self.partial_folder, upload_id + suffix)
+
+    def create(self, final_path, size, owner=None):
+        """Open a new upload of ``size`` bytes destined for ``final_path``; returns its ID"""
+        upload_id = uuid.uuid4().hex
+        meta = {'final_path': final_path, 'size': size, 'owner': owner, 'complete': False}
+        open(self._path(upload_id, PARTIAL_SUFFIX), 'wb').close()
+        with open(self._path(upload_id, META_SUFFIX), 'w') as f:
+            json.dump(meta, f)
+        return upload_id
+
+    def get(self, upload_id):
+        """Return the upload's metadata plus its acknowledged ``offset``, or None"""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(self._path(upload_id, META_SUFFIX)) as f:
+                meta = json.load(f)
+            if meta['complete']:
+                meta['offset'] = meta['size']
+            else:
+                meta['offset'] = os.path.getsize(self._path(upload_id, PARTIAL_SUFFIX))
+        except (OSError, ValueError):
+            return None
+        meta['upload_id'] = upload_id
+        return meta
+
+    def write_chunk(self, upload_id, offset, stream):
+        """Append the bytes in ``stream`` at ``offset``.
+
+        Returns ``(new_offset, error)``. A chunk that does not start at the
+        current end of the partial file is rejected with the offset to resume
+        from. Complete uploads are moved to their final path.
+        """
+        meta = self.get(upload_id)
+        if meta is None:
+            return None, "Upload not found"
+        if meta['complete']:
+            return meta['size'], "Upload already complete"
+
+        part_path = self._path(upload_id, PARTIAL_SUFFIX)
+        try:
+            f = open(part_path, 'r+b')
+        except OSError:
+            # Completed by another request in the meantime
+            return meta['size'], "Upload already complete"
+        with f:
+            lock_file(f)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                return current, f"Offset mismatch, resume from {current}"
+
+            remaining = meta['size'] - current
+            while remaining > 0:
+                block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+            if stream.read(1):
+                f.truncate(current)
+                return current, "Chunk exceeds declared upload size"
+            new_offset = f.tell()
+
+            if new_offset == meta['size']:
+                f.flush()
+                self._finish(upload_id, meta)
+        return new_offset, None
+
+    def _finish(self, upload_id, meta):
+        """Move the complete file into place and mark the upload done"""
+        os.makedirs(os.path.dirname(meta['final_path']) or '.', exist_ok=True)
+        shutil.move(self._path(upload_id, PARTIAL_SUFFIX), meta['final_path'])
+        meta = dict(meta, complete=True)
+        if self.on_complete is not None:
+            meta['final_path'] = self.on_complete(meta['final_path'])
+        meta.pop('offset', None)
+        meta.pop('upload_id', None)
+        with open(self._path(upload_id, META_SUFFIX), 'w') as f:
+            json.dump(meta, f)
+
+    def discard(self, upload_id):
+        """Drop a partial upload"""
+        for suffix in (PARTIAL_SUFFIX, META_SUFFIX):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except OSError:
+                pass
@@ -7,25 +7,47 @@ FLASK_DEBUG = True       # Debug mode (set to False for production)
 
 # File Upload Settings
 MAX_FILE_SIZE = 16 * 1024 * 1024  # Maximum file size in bytes (16MB)
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'mp4', 'mov', 'avi', 'mkv', 'webm'}
+MAX_IMAGE_MEGAPIXELS = 100        # Reject larger images (read from the header, before any decode)
 
 # AI Processing Settings
 FACE_DETECTION_CONFIDENCE = 0.5    # Minimum confidence for face detection
+MULTI_FACE = False                 # Crop every detected face instead of only the first
+MAX_FACES = 50                     # Most faces cropped from one image in multi-face mode
+FRAME_STEP = 10                    # Crop every Nth frame of videos, animated GIFs and multi-page TIFFs
+SHARPEST_FRAME_ONLY = False        # Crop only the sharpest of the sampled frames
+MAX_FRAMES = 100                   # Most frames sampled from one input
+FACE_DETECTION_PROXY_SCALE = 4     # Detect on a 1/N size proxy (1, 2, 4 or 8; 1 = full resolution)
+FACE_DETECTION_PROXY_MIN_SIDE = 480  # Never shrink the proxy's short side below this many pixels
+DETECTION_STORE = None            # SQLite file saving detections by image hash, e.g. 'detections.db' (None = off)
+DETECTION_RETENTION_DAYS = 30      # The web apps drop saved detections unused this long
 CROP_EXPANSION_HEIGHT = 2.5        # Height multiplier for crop area (includes tie area)
 CROP_EXPANSION_WIDTH = 1.8         # Width multiplier for crop area (includes shoulders)
 MIN_CROP_WIDTH = 200               # Minimum crop width in pixels
-MIN_CROP_HEIGHT = 250              # Minimum crop height in pixels
+MIN_CROP_HEIGHT = 300              # Minimum crop height in pixels
+CROP_ASPECT_RATIO = 1.285          # Output height:width ratio (ID card, 1:1.285)
+HAIR_REFINEMENT = False            # Place the crop's top edge from the detected top of the head
+HAIR_SEARCH_HEIGHT = 0.6           # Band above the face box searched for hair (face heights)
+HAIR_EDGE_THRESHOLD = 0.05         # Fraction of the face width that must be edges to count as hair
+HAIR_TOP_MARGIN = 0.2              # Space left above the hair (face heights)
 
 # Folder Settings
 UPLOAD_FOLDER = 'uploads'          # Folder for uploaded images
 OUTPUT_FOLDER = 'cropped_images'   # Folder for processed images
 
 # Performance Settings
-BATCH_SIZE = 100                   # Process images in batches of this size
-PROCESSING_DELAY = 0.1             # Delay between processing images (seconds)
+PROCESSING_WORKERS = 0             # Crop worker processes per web worker (0 = CPU cores / web workers, 1 = inline)
+MAX_IN_FLIGHT_PER_WORKER = 2       # Images queued per crop worker; bounds memory for large batches
+PROCESSING_MEMORY_BUDGET_MB = 1024 # Decoded image memory in flight per web worker, shared by its batches (0 = no limit)
+METRICS_FOLDER = 'metrics_data'    # Per-process metric snapshots merged by /metrics
 
 # Output Settings
 OUTPUT_PREFIX = '_cropped'         # Prefix for cropped image filenames
 PRESERVE_ORIGINAL_FORMAT = True    # Keep original image format
-OUTPUT_QUALITY = 95                # JPEG quality (if converting to JPEG)
+OUTPUT_FORMAT = 'jpeg'             # Output format when not preserving the original (jpeg, png or webp)
+OUTPUT_QUALITY = 95                # JPEG/WebP quality (1-100)
+PROGRESSIVE_JPEG = True            # Write progressive JPEGs (usually a little smaller)
+TARGET_FILE_SIZE_KB = 0            # Lower JPEG/WebP quality until outputs fit this size (0 = off)
+MIN_OUTPUT_QUALITY = 50            # Never go below this quality when hitting a target size
+OUTPUT_SIZE = None                 # Resize crops to exactly (width, height) pixels, e.g. (413, 531); None = keep crop size
 
@@ -0,0 +1,215 @@
+"""Content-addressed upload store and processed-output cache for app_cloud.py.
+
+Uploads are named by the SHA-256 of their bytes, so re-uploading the same
+photo set stores each file once. Outputs are named by the input hash plus a
+digest of the crop parameters; a file lock around each output makes
+concurrent requests for the same content share one computation, and later
+requests reuse the cached result.
+
+Reusing a stored file refreshes its mtime, so mtime order is least recently
+used order for the janitor's quota eviction.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: run_app.bat development server only
+    fcntl = None
+
+HASH_BLOCK_SIZE = 1024 * 1024  # Bytes read at a time while hashing
+LOCK_FOLDER = '.locks'
+RESULT_SUFFIX = '.result.json'
+
+
+def params_key(params):
+    """Short stable digest of a settings dict (crop or detector parameters)"""
+    encoded = json.dumps(params, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:12]
+
+def content_hash(path):
+    """SHA-256 of a file, read in fixed-size blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def touch(path):
+    """Mark a stored file as recently used"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _scan(folder, skip_suffix=None):
+    """(path, size, mtime) for visible files directly inside ``folder``"""
+    for entry in os.scandir(folder):
+        if entry.name.startswith('.') or (skip_suffix and entry.name.endswith(skip_suffix)):
+            continue
+        try:
+            if entry.is_file():
+                st = entry.stat()
+                yield entry.path, st.st_size, st.st_mtime
+        except OSError:
+            continue
+
+def _outputs(output_path, crop_coords):
+    """Files a result wrote: one per face in multi-face mode, else ``output_path``"""
+    if isinstance(crop_coords, list):
+        return [face['output'] for face in crop_coords]
+    return [output_path]
+
+def lock_file(f, blocking=True):
+    """Exclusively lock the open file ``f`` until it is closed.
+
+    Returns False if ``blocking`` is off and someone else holds the lock.
+    Without fcntl nothing is locked.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+@contextmanager
+def file_lock(lock_path, blocking=True):
+    """Exclusive lock shared by every thread and process on this host.
+
+    Yields whether the lock was taken, which is always True when ``blocking``.
+    """
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    with open(lock_path, 'a') as f:
+        yield lock_file(f, blocking)
+
+
+class ContentStore:
+    """Deduplicated uploads in ``upload_folder``, cached outputs in ``output_folder``"""
+
+    def __init__(self, upload_folder, output_folder):
+        self.upload_folder = upload_folder
+        self.output_folder = output_folder
+        os.makedirs(upload_folder, exist_ok=True)
+        os.makedirs(output_folder, exist_ok=True)
+
+    def upload_path(self, digest, ext):
+        return os.path.join(self.upload_folder, digest + ext.lower())
+
+    def upload_hash(self, path):
+        """Content hash of a stored upload, taken from its name; None for other paths"""
+        if not isinstance(path, str):
+            return None
+        if os.path.abspath(os.path.dirname(path)) != os.path.abspath(self.upload_folder):
+            return None
+        digest = os.path.splitext(os.path.basename(path))[0]
+        if len(digest) == 64 and all(c in '0123456789abcdef' for c in digest):
+            return digest
+        return None
+
+    def output_path(self, upload_path, params, ext=None):
+        """Cached output path for an upload under the given crop parameters
+
+        ``ext`` overrides the upload's extension when the output format differs.
+        """
+        name, upload_ext = os.path.splitext(os.path.basename(upload_path))
+        ext = upload_ext if ext is None else ext
+        return os.path.join(self.output_folder, f"{name}_{params_key(params)}_cropped{ext}")
+
+    def put_stream(self, stream, ext):
+        """Store the bytes of ``stream``, hashing while writing; returns the stored path"""
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_folder, prefix='.incoming-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+                    f.write(block)
+            return self._commit(tmp_path, digest.hexdigest(), ext)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put_bytes(self, data, ext):
+        """Store bytes already held in memory; returns the stored path"""
+        return self.put_stream(io.BytesIO(data), ext)
+
+    def bytes_path(self, data, ext):
+        """Path put_bytes would store ``data`` at (names its cached outputs without storing it)"""
+        return self.upload_path(hashlib.sha256(data).hexdigest(), ext)
+
+    def put_file(self, path, ext=None):
+        """Move an existing file (e.g. a finished chunked upload) into the store"""
+        if ext is None:
+            ext = os.path.splitext(path)[1]
+        return self._commit(path, content_hash(path), ext)
+
+    def _commit(self, tmp_path, digest, ext):
+        final_path = self.upload_path(digest, ext)
+        if os.path.exists(final_path):
+            # Identical bytes already stored
+            os.remove(tmp_path)
+            touch(final_path)
+        else:
+            shutil.move(tmp_path, final_path)
+        return final_path
+
+    def process_once(self, output_path, compute):
+        """Return ``compute()``'s ``(success, message, crop_coords)`` for ``output_path``.
+
+        The first caller runs ``compute`` while holding a lock on the output;
+        concurrent callers wait and then read the recorded result instead of
+        repeating the work. Only successful results are cached. A multi-face
+        result (a list of faces with their own ``output`` paths) stays cached
+        while every face file exists.
+        """
+        result_path = output_path + RESULT_SUFFIX
+        lock_path = os.path.join(self.output_folder, LOCK_FOLDER, os.path.basename(output_path) + '.lock')
+        with file_lock(lock_path):
+            if os.path.exists(result_path):
+                try:
+                    with open(result_path) as f:
+                        cached = json.load(f)
+                    outputs = cached.get('outputs', [output_path])
+                    if all(os.path.exists(path) for path in outputs):
+                        for path in outputs:
+                            touch(path)
+                        return True, cached['message'], cached['crop_coords']
+                except (OSError, ValueError, KeyError):
+                    pass
+
+            success, message, crop_coords = compute()
+            if success:
+                tmp_path = result_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'message': message, 'crop_coords': crop_coords,
+                               'outputs': _outputs(output_path, crop_coords)}, f)
+                os.replace(tmp_path, result_path)
+            return success, message, crop_coords
+
+    def uploads(self):
+        """(path, size, mtime) for every stored upload"""
+        return _scan(self.upload_folder)
+
+    def outputs(self):
+        """(path, size, mtime) for every cached output"""
+        return _scan(self.output_folder, skip_suffix=RESULT_SUFFIX)
+
+    def remove_output(self, output_path):
+        """Delete an output and its cached result; returns the bytes freed"""
+        freed = 0
+        for path in (output_path, output_path + RESULT_SUFFIX):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except OSError:
+                pass
+        return freed
@@ -0,0 +1,128 @@
+"""Vectorized ID-card crop geometry.
+
+Pure NumPy: takes N relative face boxes plus image sizes and returns N crop
+rectangles in one call, so re-planning a whole batch costs microseconds.
+The per-image path in cropper.py calls the same functions with N = 1.
+
+Rectangles are int64 arrays of shape (N, 4) holding [x, y, width, height]
+in full-resolution pixels.
+"""
+import numpy as np
+
+from config import (CROP_ASPECT_RATIO, CROP_EXPANSION_HEIGHT, CROP_EXPANSION_WIDTH,
+                    MIN_CROP_HEIGHT, MIN_CROP_WIDTH)
+
+
+def _trunc(values):
+    """Truncate toward zero like int()"""
+    return np.trunc(values).astype(np.int64)
+
+def expand_face_boxes(boxes, sizes, expansion_height=CROP_EXPANSION_HEIGHT,
+                      expansion_width=CROP_EXPANSION_WIDTH,
+                      min_width=MIN_CROP_WIDTH, min_height=MIN_CROP_HEIGHT):
+    """Expand relative face boxes to face + shoulders + tie, clamped to the image.
+
+    ``boxes`` is (N, 4) [xmin, ymin, width, height] relative to the image;
+    ``sizes`` is (N, 2) [height, width] in pixels.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+    h, w = sizes[:, 0], sizes[:, 1]
+
+    # Relative box maps straight onto the full-resolution frame
+    x = _trunc(boxes[:, 0] * w)
+    y = _trunc(boxes[:, 1] * h)
+    width = _trunc(boxes[:, 2] * w)
+    height = _trunc(boxes[:, 3] * h)
+
+    # Expand the crop area to include the chest (tie knot) and shoulders
+    expanded_height = _trunc(height * expansion_height)
+    expanded_width = _trunc(width * expansion_width)
+
+    # Adjust coordinates to stay within image bounds
+    start_x = np.maximum(0, x - (expanded_width - width) // 2)
+    start_y = np.maximum(0, y - (expanded_height - height) // 2)
+    end_x = np.minimum(w, start_x + expanded_width)
+    end_y = np.minimum(h, start_y + expanded_height)
+
+    # Ensure minimum dimensions
+    narrow = end_x - start_x < min_width
+    center_x = (start_x + end_x) // 2
+    start_x = np.where(narrow, np.maximum(0, center_x - min_width // 2), start_x)
+    end_x = np.where(narrow, np.minimum(w, center_x + min_width // 2), end_x)
+
+    short = end_y - start_y < min_height
+    center_y = (start_y + end_y) // 2
+    start_y = np.where(short, np.maximum(0, center_y - min_height // 2), start_y)
+    end_y = np.where(short, np.minimum(h, center_y + min_height // 2), end_y)
+
+    return np.stack([start_x, start_y, end_x - start_x, end_y - start_y], axis=1)
+
+def center_boxes(sizes):
+    """Center crops (half the short side) used when no face was detected"""
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+    h, w = sizes[:, 0], sizes[:, 1]
+    crop_size = np.minimum(w, h) // 2
+
+    return np.stack([
+        np.maximum(0, w // 2 - crop_size // 2),
+        np.maximum(0, h // 2 - crop_size // 2),
+        np.minimum(crop_size, w),
+        np.minimum(crop_size, h),
+    ], axis=1)
+
+def plan_crops(boxes, sizes, found=None):
+    """Crop rectangles for N images; rows where ``found`` is False get a center crop"""
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+    rects = expand_face_boxes(boxes, sizes)
+    if found is not None:
+        found = np.asarray(found, dtype=bool).reshape(-1)
+        rects = np.where(found[:, None], rects, center_boxes(sizes))
+    return rects
+
+def fit_aspect_ratio(rects, aspect_ratio=CROP_ASPECT_RATIO):
+    """Trim rectangles to width:height = 1:aspect_ratio, keeping them centered"""
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    x, y, w, h = (rects[:, i].copy() for i in range(4))
+    target_ratio = 1.0 / aspect_ratio  # width/height ratio
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        current_ratio = w / h
+    too_wide = current_ratio > target_ratio
+    too_tall = current_ratio < target_ratio
+
+    # Too wide: reduce width, center horizontally
+    new_width = _trunc(h * target_ratio)
+    x = np.where(too_wide, x + (w - new_width) // 2, x)
+    w = np.where(too_wide, new_width, w)
+
+    # Too tall: reduce height, center vertically
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_height = _trunc(np.where(too_tall, w / target_ratio, h))
+    y = np.where(too_tall, y + (h - new_height) // 2, y)
+    h = np.where(too_tall, new_height, h)
+
+    return np.stack([x, y, w, h], axis=1)
+
+def align_top(rects, tops, sizes, aspect_ratio=CROP_ASPECT_RATIO):
+    """Shift rectangles vertically so their aspect-fitted crop starts at ``tops``.
+
+    Rows where ``tops`` is negative are left alone. Shifted rectangles stay
+    inside the image, so the requested top is not always reached.
+    """
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4).copy()
+    tops = np.asarray(tops, dtype=np.int64).reshape(-1)
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+    fitted_y = fit_aspect_ratio(rects, aspect_ratio)[:, 1]
+    shifted = np.clip(rects[:, 1] + tops - fitted_y, 0, sizes[:, 0] - rects[:, 3])
+    rects[:, 1] = np.where(tops >= 0, shifted, rects[:, 1])
+    return rects
+
+def final_crop_rects(boxes, sizes, found=None, aspect_ratio=CROP_ASPECT_RATIO):
+    """Planned crops trimmed to the ID-card aspect ratio, in one vectorized pass"""
+    return fit_aspect_ratio(plan_crops(boxes, sizes, found), aspect_ratio)
+
+def rect_to_coords(rect):
+    """One [x, y, width, height] row as the crop_coords dict used in results"""
+    x, y, width, height = (int(v) for v in rect)
+    return {'x': x, 'y': y, 'width': width, 'height': height}
@@ -0,0 +1,537 @@
+"""Face detection and ID-card cropping shared by app.py and app_cloud.py.
+
+Each image is decoded once: detection and cropping both work on the same
+in-memory BGR array. Paths are still accepted for one-off calls. In
+multi-face mode every detected face is cropped from that one decode, and
+videos and multi-frame images are streamed a frame at a time.
+
+Face detection runs on a reduced-resolution proxy (see
+FACE_DETECTION_PROXY_SCALE in config.py); MediaPipe returns a relative box,
+which maps straight back onto the full-resolution frame. Detections can be
+saved by content hash (see detection_store.py), so when only the crop
+parameters change an image is re-planned from its stored faces.
+"""
+import hashlib
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import crop_geometry
+import metrics
+from content_store import content_hash
+from config import (CROP_ASPECT_RATIO, CROP_EXPANSION_HEIGHT, CROP_EXPANSION_WIDTH,
+                    FACE_DETECTION_CONFIDENCE, FACE_DETECTION_PROXY_MIN_SIDE,
+                    FACE_DETECTION_PROXY_SCALE, HAIR_EDGE_THRESHOLD, HAIR_REFINEMENT,
+                    HAIR_SEARCH_HEIGHT, HAIR_TOP_MARGIN, MAX_FACES, MIN_CROP_HEIGHT,
+                    MIN_CROP_WIDTH)
+from face_detector import get_face_detector
+from frame_source import frame_sampling_options, select_frames
+from hair_detection import find_hair_top
+from output_encoding import encode_image, encoding_options
+
+# Everything that changes the output for a given input; outputs are cached
+# under a digest of these values (see content_store.py)
+CROP_PARAMETERS = {
+    'expansion_height': CROP_EXPANSION_HEIGHT,
+    'expansion_width': CROP_EXPANSION_WIDTH,
+    'min_width': MIN_CROP_WIDTH,
+    'min_height': MIN_CROP_HEIGHT,
+    'aspect_ratio': CROP_ASPECT_RATIO,
+    'proxy_scale': FACE_DETECTION_PROXY_SCALE,
+    'proxy_min_side': FACE_DETECTION_PROXY_MIN_SIDE,
+    'hair_refinement': HAIR_REFINEMENT,
+    'hair_search_height': HAIR_SEARCH_HEIGHT,
+    'hair_edge_threshold': HAIR_EDGE_THRESHOLD,
+    'hair_top_margin': HAIR_TOP_MARGIN,
+}
+
+# Everything that changes what the detector finds; stored detections are
+# only reused under the same values
+DETECTION_PARAMETERS = {
+    'model_selection': 1,
+    'confidence': FACE_DETECTION_CONFIDENCE,
+    'proxy_scale': FACE_DETECTION_PROXY_SCALE,
+    'proxy_min_side': FACE_DETECTION_PROXY_MIN_SIDE,
+}
+
+# Relative face box, with the attribute names of MediaPipe's bounding box
+Box = namedtuple('Box', 'xmin ymin width height')
+
+# cv2.imread flags that decode at 1/N size (DCT scaling for JPEG)
+REDUCED_READ_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def load_image(image):
+    """Return a decoded BGR array for a path or encoded bytes, or the array itself if already decoded"""
+    if isinstance(image, str):
+        return cv2.imread(image)
+    if isinstance(image, bytes):
+        return cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    return image
+
+def read_image_size(image_path):
+    """Return (height, width) from the file header without decoding pixels.
+
+    Matches cv2.imread, which applies the EXIF orientation tag.
+    """
+    with Image.open(image_path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return height, width
+
+def proxy_scale_for(h, w, max_scale=FACE_DETECTION_PROXY_SCALE):
+    """Largest reduction factor (1, 2, 4 or 8) that keeps the proxy's short side usable"""
+    scale = 1
+    for candidate in (2, 4, 8):
+        if candidate > max_scale or min(h, w) // candidate < FACE_DETECTION_PROXY_MIN_SIDE:
+            break
+        scale = candidate
+    return scale
+
+def load_detection_proxy(image, max_scale=FACE_DETECTION_PROXY_SCALE):
+    """Return ``(proxy, (h, w))``: a small BGR frame for detection plus the full size.
+
+    For a path, the proxy is decoded directly at reduced size. For a decoded
+    array, it is downscaled with area interpolation.
+    """
+    if isinstance(image, str):
+        try:
+            h, w = read_image_size(image)
+        except Exception:
+            image = cv2.imread(image)
+            if image is None:
+                return None, None
+            return load_detection_proxy(image, max_scale)
+        scale = proxy_scale_for(h, w, max_scale)
+        proxy = cv2.imread(image, REDUCED_READ_FLAGS.get(scale, cv2.IMREAD_COLOR))
+        return proxy, (h, w)
+
+    if image is None:
+        return None, None
+    h, w = image.shape[:2]
+    scale = proxy_scale_for(h, w, max_scale)
+    if scale == 1:
+        return image, (h, w)
+    proxy = cv2.resize(image, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    return proxy, (h, w)
+
+def plan_face_crop(bbox, h, w):
+    """Expand a relative face box into full-resolution crop coordinates"""
+    box = (bbox.xmin, bbox.ymin, bbox.width, bbox.height)
+    return crop_geometry.rect_to_coords(crop_geometry.expand_face_boxes(box, (h, w))[0])
+
+def plan_center_crop(h, w):
+    """Center crop used when no face is detected"""
+    return crop_geometry.rect_to_coords(crop_geometry.center_boxes((h, w))[0])
+
+def refine_hair_top(proxy, bbox, crop_coords, h, w):
+    """Move a face crop vertically so it leaves HAIR_TOP_MARGIN above the hair
+
+    The hair is searched on the detection proxy; the crop is unchanged if
+    none is found.
+    """
+    ph, pw = proxy.shape[:2]
+    face_box = (int(bbox.xmin * pw), int(bbox.ymin * ph), int(bbox.width * pw), int(bbox.height * ph))
+    hair_top = find_hair_top(proxy, face_box)
+    if hair_top is None:
+        return crop_coords
+
+    top = int(hair_top * h / ph) - int(bbox.height * h * HAIR_TOP_MARGIN)
+    rect = (crop_coords['x'], crop_coords['y'], crop_coords['width'], crop_coords['height'])
+    return crop_geometry.rect_to_coords(crop_geometry.align_top(rect, max(0, top), (h, w))[0])
+
+def detection_records(detections):
+    """Compact, JSON-ready copies of MediaPipe detections: relative box, keypoints, score"""
+    records = []
+    for detection in detections:
+        data = detection.location_data
+        b = data.relative_bounding_box
+        records.append({
+            'box': [round(v, 5) for v in (b.xmin, b.ymin, b.width, b.height)],
+            'keypoints': [[round(k.x, 5), round(k.y, 5)] for k in data.relative_keypoints],
+            'score': round(float(detection.score[0]), 4),
+        })
+    return records
+
+def detection_key(image):
+    """Content hash naming an image's stored detections (None for decoded arrays)"""
+    if isinstance(image, str):
+        return content_hash(image)
+    if isinstance(image, bytes):
+        return hashlib.sha256(image).hexdigest()
+    return None
+
+def run_detection(image, proxy_scale=FACE_DETECTION_PROXY_SCALE):
+    """Decode a detection proxy and run one inference pass over it.
+
+    Returns ``(proxy, (h, w), records)``; ``records`` is a possibly empty
+    list (see detection_records), and ``proxy`` is None if the image could
+    not be read.
+    """
+    # Read a reduced-size proxy for detection
+    proxy, full_size = load_detection_proxy(image, proxy_scale)
+    if proxy is None:
+        return None, None, []
+
+    # Convert only the proxy to RGB for MediaPipe
+    rgb_image = cv2.cvtColor(proxy, cv2.COLOR_BGR2RGB)
+
+    # Reuse this worker's warm face detector
+    face_detection = get_face_detector()
+    results = face_detection.process(rgb_image)
+    del rgb_image
+
+    records = detection_records(results.detections or [])
+    metrics.inc('crop_detections_total', result='hit' if records else 'miss')
+    return proxy, full_size, records
+
+def locate_faces(image, proxy_scale=FACE_DETECTION_PROXY_SCALE, store=None, key=None,
+                 stored_only=False):
+    """Detection records for ``image``, from ``store`` when it has them.
+
+    Returns ``(proxy, (h, w), records)`` like run_detection. ``key`` is the
+    image's detection_key; without one the store is not used. On a store
+    hit nothing is decoded and ``proxy`` is None. Misses run detection and
+    are saved, unless ``stored_only``, which raises LookupError instead.
+    """
+    if store is not None and key is not None:
+        stored = store.get(key)
+        if stored is not None:
+            metrics.inc('crop_detection_store_total', result='hit')
+            return None, stored[0], stored[1]
+        metrics.inc('crop_detection_store_total', result='miss')
+    if stored_only:
+        raise LookupError("No stored detections for this image; crop it normally first")
+
+    proxy, full_size, records = run_detection(image, proxy_scale)
+    if store is not None and key is not None and proxy is not None:
+        store.put(key, full_size, records)
+    return proxy, full_size, records
+
+def hair_proxy(image, proxy, proxy_scale=FACE_DETECTION_PROXY_SCALE):
+    """The detection proxy, rebuilt from ``image`` when detections came from the store"""
+    return proxy if proxy is not None else load_detection_proxy(image, proxy_scale)[0]
+
+def detect_face_and_tie(image, proxy_scale=FACE_DETECTION_PROXY_SCALE, refine_hair=HAIR_REFINEMENT,
+                        store=None, key=None, stored_only=False):
+    """Detect face and tie area using AI for ID card style cropping
+
+    ``image`` may be a file path, encoded bytes or an already decoded BGR
+    array. Detection runs on a proxy reduced by up to ``proxy_scale`` (1 =
+    full resolution); the returned crop coordinates are in full-resolution
+    pixels. With ``refine_hair`` the crop's top edge is placed from the top
+    of the head. ``store``, ``key`` and ``stored_only`` reuse saved
+    detections (see locate_faces).
+    """
+    try:
+        proxy, full_size, records = locate_faces(image, proxy_scale, store, key, stored_only)
+        if full_size is None:
+            return None, "Could not read image"
+        h, w = full_size
+
+        if records:
+            # Get the first detected face
+            bbox = Box(*records[0]['box'])
+            crop_coords = plan_face_crop(bbox, h, w)
+            if refine_hair:
+                with metrics.timed('hair'):
+                    proxy = hair_proxy(image, proxy, proxy_scale)
+                    crop_coords = refine_hair_top(proxy, bbox, crop_coords, h, w)
+            return crop_coords, None
+        else:
+            # Fallback: use center crop if no face detected
+            return plan_center_crop(h, w), "No face detected, using center crop"
+
+    except Exception as e:
+        return None, str(e)
+
+def detect_faces(image, proxy_scale=FACE_DETECTION_PROXY_SCALE, refine_hair=HAIR_REFINEMENT,
+                 max_faces=MAX_FACES, store=None, key=None, stored_only=False):
+    """Crop coordinates for every face at or above FACE_DETECTION_CONFIDENCE
+
+    Same inputs as detect_face_and_tie. Returns ``(faces, message)`` where
+    ``faces`` lists ``{'crop_coords', 'score'}`` from left to right, at most
+    ``max_faces`` of them. All crops are planned in one vectorized call.
+    With no face, a single center crop is returned as in single-face mode.
+    """
+    try:
+        proxy, full_size, records = locate_faces(image, proxy_scale, store, key, stored_only)
+        if full_size is None:
+            return None, "Could not read image"
+        h, w = full_size
+
+        records = [r for r in records if r['score'] >= FACE_DETECTION_CONFIDENCE]
+        # Keep the most confident faces, then number them left to right
+        records = sorted(records, key=lambda r: -r['score'])[:max_faces]
+        records.sort(key=lambda r: r['box'][0])
+        if not records:
+            return [{'crop_coords': plan_center_crop(h, w), 'score': None}], \
+                "No face detected, using center crop"
+
+        bboxes = [Box(*r['box']) for r in records]
+        rects = crop_geometry.expand_face_boxes([r['box'] for r in records], [(h, w)] * len(records))
+        if refine_hair:
+            proxy = hair_proxy(image, proxy, proxy_scale)
+        faces = []
+        for record, bbox, rect in zip(records, bboxes, rects):
+            crop_coords = crop_geometry.rect_to_coords(rect)
+            if refine_hair:
+                with metrics.timed('hair'):
+                    crop_coords = refine_hair_top(proxy, bbox, crop_coords, h, w)
+            faces.append({'crop_coords': crop_coords, 'score': round(record['score'], 3)})
+        return faces, f"{len(faces)} face(s) detected"
+
+    except Exception as e:
+        return None, str(e)
+
+def crop_to_aspect(image, crop_coords, aspect_ratio=CROP_ASPECT_RATIO):
+    """Cut the crop box out of the frame and trim it to ``aspect_ratio`` (1:1.285 by default; views only)"""
+    # First crop the image based on detected coordinates (a view, no copy)
+    cropped = image[
+        crop_coords['y']:crop_coords['y'] + crop_coords['height'],
+        crop_coords['x']:crop_coords['x'] + crop_coords['width']
+    ]
+
+    # Now trim to maintain the ID card aspect ratio, centered
+    h, w = cropped.shape[:2]
+    x, y, new_w, new_h = crop_geometry.fit_aspect_ratio((0, 0, w, h), aspect_ratio)[0]
+    return cropped[y:y + new_h, x:x + new_w]
+
+def resize_to(image, size):
+    """Resize to exact (width, height): pyramid halving while at least 2x too big, then area"""
+    width, height = size
+    while image.shape[0] >= 2 * height and image.shape[1] >= 2 * width:
+        image = cv2.pyrDown(image)
+    if image.shape[:2] == (height, width):
+        return image
+    # Area interpolation for shrinking; cubic when a small crop has to grow
+    shrinking = image.shape[0] > height
+    return cv2.resize(image, (width, height),
+                      interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_CUBIC)
+
+def reduced_scale_for(crops, size):
+    """Largest decode reduction (1, 2, 4 or 8) that keeps every crop at least ``size``"""
+    width, height = size
+    scale = 1
+    for candidate in (2, 4, 8):
+        if any(c['width'] // candidate < width or c['height'] // candidate < height for c in crops):
+            break
+        scale = candidate
+    return scale
+
+def can_decode_reduced(image):
+    """Whether a reduced decode actually saves work (JPEG files; DCT scaling)"""
+    return isinstance(image, str) and os.path.splitext(image)[1].lower() in ('.jpg', '.jpeg')
+
+def load_reduced(image_path, scale):
+    """Decode at 1/``scale`` size"""
+    return cv2.imread(image_path, REDUCED_READ_FLAGS.get(scale, cv2.IMREAD_COLOR))
+
+def scale_crop_coords(crop_coords, scale):
+    """Full-resolution crop coordinates mapped onto a 1/``scale`` decode"""
+    if scale == 1:
+        return crop_coords
+    return {key: value // scale for key, value in crop_coords.items()}
+
+def crop_image(image, crop_coords, output_path, encoding=None):
+    """Crop image based on detected coordinates and maintain 1:1.285 aspect ratio
+
+    ``image`` may be a file path, encoded bytes or a decoded BGR array. The output
+    format follows ``output_path``'s extension; ``encoding`` holds the
+    quality and output size settings (see output_encoding.encoding_options)
+    and defaults to the config.py output settings. With an output size, the
+    crop is trimmed to that size's aspect ratio and resized to it.
+    """
+    try:
+        if encoding is None:
+            encoding = encoding_options()
+        image = load_image(image)
+        if image is None:
+            return False, "Could not read image"
+
+        size = encoding['size']
+        with metrics.timed('crop'):
+            if size:
+                cropped = crop_to_aspect(image, crop_coords, size[1] / size[0])
+            else:
+                cropped = crop_to_aspect(image, crop_coords)
+        if size:
+            with metrics.timed('resize'):
+                cropped = resize_to(cropped, size)
+
+        # Save cropped image with correct aspect ratio
+        with metrics.timed('encode'):
+            buffer = encode_image(cropped, os.path.splitext(output_path)[1], encoding)
+            with open(output_path, 'wb') as f:
+                f.write(buffer)
+        return True, "Success"
+
+    except Exception as e:
+        return False, str(e)
+
+def detection_lookup(image_path, detections=None, recrop=False, content_key=None):
+    """Keyword arguments letting the detect_* functions reuse stored detections
+
+    ``content_key`` is the image's content hash when it is already known,
+    which saves reading the whole file to hash it.
+    """
+    if detections is None:
+        return {'stored_only': recrop}
+    key = content_key or detection_key(image_path)
+    return {'store': detections, 'key': key, 'stored_only': recrop}
+
+def process_image(image_path, output_path, encoding=None, detections=None, recrop=False,
+                  content_key=None):
+    """Decode once, detect, crop and save a single image.
+
+    With an output size much smaller than the crop, a JPEG is detected on
+    its proxy first and then decoded at reduced size (see reduced_scale_for).
+    ``detections`` is a DetectionStore that saves and reuses detections by
+    content hash (``content_key`` if known, e.g. from a content-store name).
+    With ``recrop`` the crop is planned from stored detections only, so the
+    detector never runs; images without any fail.
+    Returns ``(success, message, crop_coords)``; ``crop_coords`` is None on
+    failure and always in full-resolution pixels.
+    """
+    if encoding is None:
+        encoding = encoding_options()
+    lookup = detection_lookup(image_path, detections, recrop, content_key)
+    if encoding['size'] and can_decode_reduced(image_path):
+        with metrics.timed('detection'):
+            crop_coords, message = detect_face_and_tie(image_path, **lookup)
+        if not crop_coords:
+            metrics.inc('crop_images_total', result='failure')
+            return False, message, None
+        scale = reduced_scale_for([crop_coords], encoding['size'])
+        with metrics.timed('decode'):
+            image = load_reduced(image_path, scale)
+        if image is None:
+            metrics.inc('crop_images_total', result='failure')
+            return False, "Could not read image", None
+        success, crop_message = crop_image(
+            image, scale_crop_coords(crop_coords, scale), output_path, encoding)
+        metrics.inc('crop_images_total', result='success' if success else 'failure')
+        return success, crop_message or message, crop_coords if success else None
+
+    with metrics.timed('decode'):
+        image = load_image(image_path)
+    if image is None:
+        metrics.inc('crop_images_total', result='failure')
+        return False, "Could not read image", None
+
+    with metrics.timed('detection'):
+        crop_coords, message = detect_face_and_tie(image, **lookup)
+    if not crop_coords:
+        metrics.inc('crop_images_total', result='failure')
+        return False, message, None
+
+    success, crop_message = crop_image(image, crop_coords, output_path, encoding)
+    metrics.inc('crop_images_total', result='success' if success else 'failure')
+    return success, crop_message or message, crop_coords if success else None
+
+def face_output_path(output_path, index):
+    """Output path of the ``index``-th face (1-based): a_cropped.jpg -> a_cropped_face2.jpg"""
+    name, ext = os.path.splitext(output_path)
+    return f"{name}_face{index}{ext}"
+
+def process_image_faces(image_path, output_path, encoding=None, detections=None, recrop=False,
+                        content_key=None):
+    """Decode once, detect every face, and save one crop per face.
+
+    Faces are written to face_output_path(output_path, i); ``output_path``
+    itself is not written. Returns ``(success, message, faces)`` where
+    ``faces`` lists ``{'face', 'output', 'crop_coords', 'score'}`` from left
+    to right, or None on failure. As in process_image, an output size lets
+    a JPEG be decoded at reduced size after detecting on its proxy, and
+    ``detections``, ``recrop`` and ``content_key`` reuse stored detections.
+    """
+    if encoding is None:
+        encoding = encoding_options()
+    lookup = detection_lookup(image_path, detections, recrop, content_key)
+    scale = 1
+    if encoding['size'] and can_decode_reduced(image_path):
+        with metrics.timed('detection'):
+            faces, message = detect_faces(image_path, **lookup)
+        if faces:
+            scale = reduced_scale_for([f['crop_coords'] for f in faces], encoding['size'])
+            with metrics.timed('decode'):
+                image = load_reduced(image_path, scale)
+            if image is None:
+                metrics.inc('crop_images_total', result='failure')
+                return False, "Could not read image", None
+    else:
+        with metrics.timed('decode'):
+            image = load_image(image_path)
+        if image is None:
+            metrics.inc('crop_images_total', result='failure')
+            return False, "Could not read image", None
+
+        with metrics.timed('detection'):
+            faces, message = detect_faces(image, **lookup)
+    if not faces:
+        metrics.inc('crop_images_total', result='failure')
+        return False, message, None
+
+    results = []
+    for index, face in enumerate(faces, 1):
+        face_path = face_output_path(output_path, index)
+        success, crop_message = crop_image(
+            image, scale_crop_coords(face['crop_coords'], scale), face_path, encoding)
+        if not success:
+            metrics.inc('crop_images_total', result='failure')
+            return False, f"Face {index}: {crop_message}", None
+        results.append(dict(face, face=index, output=face_path))
+
+    metrics.inc('crop_images_total', result='success')
+    return True, message, results
+
+def frame_output_path(output_path, index):
+    """Output path of frame ``index`` (0-based): a_cropped.jpg -> a_cropped_frame12.jpg"""
+    name, ext = os.path.splitext(output_path)
+    return f"{name}_frame{index}{ext}"
+
+def process_frames(image_path, output_path, encoding=None, multi_face=False, sampling=None):
+    """Crop sampled frames of a video, animated GIF or multi-page TIFF.
+
+    Frames are streamed from ``image_path`` and cropped in memory, one at a
+    time; ``sampling`` picks them (see frame_source.frame_sampling_options).
+    Frame ``i`` is written to frame_output_path(output_path, i), with
+    face_output_path applied on top in multi-face mode. Returns
+    ``(success, message, crops)`` where ``crops`` lists ``{'frame', 'output',
+    'crop_coords'}`` (plus ``'face'`` and ``'score'`` per face), or None if
+    no frame could be cropped.
+    """
+    if sampling is None:
+        sampling = frame_sampling_options()
+    crops = []
+    errors = 0
+    try:
+        for index, frame in select_frames(image_path, sampling):
+            frame_path = frame_output_path(output_path, index)
+            if multi_face:
+                success, message, faces = process_image_faces(frame, frame_path, encoding)
+                if success:
+                    crops.extend(dict(face, frame=index) for face in faces)
+            else:
+                success, message, crop_coords = process_image(frame, frame_path, encoding)
+                if success:
+                    crops.append({'frame': index, 'output': frame_path, 'crop_coords': crop_coords})
+            errors += not success
+    except Exception as e:
+        return False, str(e), None
+
+    if not crops:
+        return False, "No frames could be cropped", None
+    frames = len({crop['frame'] for crop in crops})
+    message = f"{frames} frame(s) cropped"
+    if errors:
+        message += f", {errors} failed"
+    return True, message, crops
@@ -0,0 +1,80 @@
+"""Persistent face detections, keyed by image content hash.
+
+Detection is the expensive part of a crop; planning the crop from a face box
+is arithmetic. Every detection result (relative boxes, keypoints and scores,
+plus the frame size) is kept in a WAL-mode SQLite file shared by all worker
+processes, so changing crop parameters such as CROP_EXPANSION_HEIGHT or the
+aspect ratio re-plans crops from stored detections instead of running
+MediaPipe again. Rows are keyed by the SHA-256 of the image bytes and by a
+digest of the detector settings, so changing those misses the store.
+"""
+import json
+import threading
+import time
+
+from content_store import params_key
+from sqlite_store import SQLiteStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    content_hash TEXT NOT NULL,
+    detector TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    detections TEXT NOT NULL,
+    used_at REAL NOT NULL,
+    PRIMARY KEY (content_hash, detector)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS detections_used_at ON detections (used_at);
+"""
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class DetectionStore(SQLiteStore):
+    """Stored detections for one set of detector settings (``params``)"""
+
+    def __init__(self, db_path, params):
+        self.detector = params_key(params)
+        super().__init__(db_path, SCHEMA)
+
+    def get(self, content_hash):
+        """``((h, w), detections)`` stored for the content, or None"""
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT width, height, detections FROM detections WHERE content_hash = ? AND detector = ?',
+            (content_hash, self.detector)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE detections SET used_at = ? WHERE content_hash = ? AND detector = ?',
+                     (time.time(), content_hash, self.detector))
+        width, height, detections = row
+        return (height, width), json.loads(detections)
+
+    def put(self, content_hash, size, detections):
+        """Store the frame size ``(h, w)`` and detection records for the content"""
+        height, width = size
+        self._conn().execute(
+            'INSERT OR REPLACE INTO detections '
+            '(content_hash, detector, width, height, detections, used_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (content_hash, self.detector, width, height,
+             json.dumps(detections, separators=(',', ':')), time.time()))
+
+    def prune(self, max_age):
+        """Drop detections not used for ``max_age`` seconds; returns the number removed"""
+        cursor = self._conn().execute('DELETE FROM detections WHERE used_at < ?',
+                                      (time.time() - max_age,))
+        return cursor.rowcount
+
+
+def get_detection_store(db_path, params):
+    """This process's store at ``db_path`` for detector ``params``; None if ``db_path`` is empty"""
+    if not db_path:
+        return None
+    key = (db_path, params_key(params))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = DetectionStore(db_path, params)
+        return store
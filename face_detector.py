@@ -0,0 +1,79 @@
+"""Pooled MediaPipe face detectors shared by app.py and app_cloud.py.
+
+Building a FaceDetection instance loads the TFLite graph, which costs more
+than running it on one image. Each worker keeps one warm detector per
+thread that crops (gunicorn's gthread workers serve requests on several)
+and reuses it for every image.
+
+MediaPipe itself (which pulls in matplotlib) is imported on first use, so
+processes that never detect, such as web workers handing crops to the
+process pool, do not load it.
+"""
+import atexit
+import os
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from config import FACE_DETECTION_CONFIDENCE
+
+WARM_UP_SIZE = 64  # Side of the blank frame run through a new detector
+
+_local = threading.local()
+_registry_lock = threading.Lock()
+_detectors = []  # (pid, detector) for every detector created, so they can be closed
+_generation = 0  # bumped by close_face_detectors so threads drop closed detectors
+
+
+def get_face_detector():
+    """Return the warm face detector owned by the calling thread.
+
+    MediaPipe graphs are not safe to share between threads, so each thread
+    gets its own. A detector inherited across fork (e.g. built in the gunicorn
+    master with preload_app) is never reused by the child.
+    """
+    pid = os.getpid()
+    detector = getattr(_local, 'detector', None)
+    if (detector is None or getattr(_local, 'pid', None) != pid
+            or getattr(_local, 'generation', None) != _generation):
+        import mediapipe as mp
+
+        detector = mp.solutions.face_detection.FaceDetection(
+            model_selection=1, min_detection_confidence=FACE_DETECTION_CONFIDENCE)
+        _local.detector = detector
+        _local.pid = pid
+        _local.generation = _generation
+        with _registry_lock:
+            _detectors.append((pid, detector))
+    return detector
+
+
+def warm_face_detector():
+    """Build the calling thread's detector and run it once, so no image pays for start-up"""
+    started = time.perf_counter()
+    get_face_detector().process(np.zeros((WARM_UP_SIZE, WARM_UP_SIZE, 3), np.uint8))
+    metrics.set_gauge('crop_startup_seconds', time.perf_counter() - started, phase='detector')
+
+
+def close_face_detectors():
+    """Close every detector created by this process.
+
+    Called from the gunicorn worker_exit hook when a worker is recycled, and
+    at interpreter exit for the development server.
+    """
+    global _generation
+    pid = os.getpid()
+    with _registry_lock:
+        _generation += 1
+        owned = [d for p, d in _detectors if p == pid]
+        _detectors[:] = [(p, d) for p, d in _detectors if p != pid]
+    for detector in owned:
+        try:
+            detector.close()
+        except Exception:
+            pass
+
+
+atexit.register(close_face_detectors)
@@ -0,0 +1,96 @@
+"""Lazy frame streaming from multi-page TIFFs, animated GIFs and video clips.
+
+Frames are decoded one at a time and handed to the crop pipeline as BGR
+arrays; nothing is written to disk in between. Memory stays at one frame
+(two when picking the sharpest) however long the input is. Skipped video
+frames are only grabbed, not decoded.
+"""
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from config import FRAME_STEP, MAX_FRAMES, SHARPEST_FRAME_ONLY
+
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi', 'mkv', 'webm', 'm4v'}
+SHARPNESS_MAX_SIDE = 512  # Frames are scored on a copy no larger than this
+
+
+def is_video(path):
+    return os.path.splitext(path)[1][1:].lower() in VIDEO_EXTENSIONS
+
+def frame_sampling_options(step=None, sharpest=None, max_frames=None):
+    """Validated frame sampling options, with config.py defaults; raises ValueError"""
+    step = FRAME_STEP if step is None else step
+    if isinstance(step, bool) or not isinstance(step, int) or step < 1:
+        raise ValueError("Frame step must be a positive integer")
+
+    sharpest = SHARPEST_FRAME_ONLY if sharpest is None else sharpest
+    if not isinstance(sharpest, bool):
+        raise ValueError("Sharpest frame must be true or false")
+
+    max_frames = MAX_FRAMES if max_frames is None else max_frames
+    if isinstance(max_frames, bool) or not isinstance(max_frames, int) or max_frames < 1:
+        raise ValueError("Max frames must be a positive integer")
+
+    return {'step': step, 'sharpest': sharpest, 'max_frames': max_frames}
+
+def _iter_video_frames(path, step):
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Could not open video")
+    try:
+        index = 0
+        while True:
+            if index % step == 0:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield index, frame
+            elif not capture.grab():
+                return
+            index += 1
+    finally:
+        capture.release()
+
+def _iter_image_frames(path, step):
+    with Image.open(path) as img:
+        for index in range(0, getattr(img, 'n_frames', 1), step):
+            img.seek(index)
+            yield index, cv2.cvtColor(np.asarray(img.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+def iter_frames(path, step=1, max_frames=None):
+    """Yield ``(index, frame)`` for every ``step``-th frame, decoding lazily"""
+    frames = _iter_video_frames(path, step) if is_video(path) else _iter_image_frames(path, step)
+    try:
+        for count, item in enumerate(frames):
+            if max_frames is not None and count >= max_frames:
+                return
+            yield item
+    finally:
+        frames.close()
+
+def sharpness(frame):
+    """Variance of the Laplacian of a downscaled grayscale copy (higher = sharper)"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    h, w = gray.shape
+    scale = SHARPNESS_MAX_SIDE / max(h, w)
+    if scale < 1:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+def select_frames(path, options):
+    """Frames to crop under the sampling ``options``: each sampled frame, or only the sharpest"""
+    frames = iter_frames(path, options['step'], options['max_frames'])
+    if not options['sharpest']:
+        yield from frames
+        return
+
+    best, best_score = None, -1.0
+    for index, frame in frames:
+        score = sharpness(frame)
+        if score > best_score:
+            best, best_score = (index, frame), score
+    if best is not None:
+        yield best
@@ -1,9 +1,41 @@
+import os
+
 bind = "0.0.0.0:10000"
-workers = 2
-worker_class = "sync"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# Each worker runs its own crop pool; batch.worker_count splits the cores between them
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "gthread"
+threads = 8  # Requests served at once per worker; each open /jobs/<id>/events stream holds one
 worker_connections = 1000
 timeout = 120
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 100
 preload_app = True
+
+
+def on_starting(server):
+    # Drop metric snapshots left by a previous run
+    from metrics import reset_metrics_folder
+    reset_metrics_folder()
+
+
+def post_fork(server, worker):
+    # Load and run the face detector now rather than on the first /process
+    from worker_startup import warm_up
+    warm_up()
+
+
+def worker_exit(server, worker):
+    # Hand this worker's unfinished background jobs to the other workers. First,
+    # so a job whose batch breaks as the pool stops is not marked failed.
+    from jobs import shutdown_jobs
+    shutdown_jobs()
+
+    # Release pooled face detectors when a worker is recycled (max_requests)
+    from face_detector import close_face_detectors
+    close_face_detectors()
+
+    # Stop the crop process pool started by the batch engine
+    from batch import shutdown_pool
+    shutdown_pool()
@@ -0,0 +1,139 @@
+"""Header-only image probing for upload validation and memory admission.
+
+Uploads are probed once when they arrive: PIL reads only the file header to
+get the dimensions, channels and format, without decoding any pixels. Images
+over MAX_IMAGE_MEGAPIXELS (including decompression bombs, whose header claims
+far more pixels than the file could hold) are rejected before anything is
+decoded. The probe is saved in a hidden sidecar next to the upload, so the
+batch scheduler can plan memory without opening the image again.
+"""
+import io
+import json
+import os
+import warnings
+
+import cv2
+from PIL import Image
+
+from config import MAX_IMAGE_MEGAPIXELS
+from frame_source import is_video
+
+PROBE_SUFFIX = '.probe.json'
+DECODED_CHANNELS = 3  # cv2.imread decodes to 8-bit BGR
+
+
+class ImageRejected(ValueError):
+    """The image cannot be processed safely; raised before any decode"""
+
+
+def probe_path(image_path):
+    """Sidecar path holding ``image_path``'s probe"""
+    folder, filename = os.path.split(image_path)
+    return os.path.join(folder, '.' + filename + PROBE_SUFFIX)
+
+def probe_video(video_path):
+    """Frame size and count from a video container's headers; raises ImageRejected"""
+    capture = cv2.VideoCapture(video_path)
+    try:
+        if not capture.isOpened():
+            raise ImageRejected("Not a readable video")
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        capture.release()
+    if width <= 0 or height <= 0:
+        raise ImageRejected("Not a readable video")
+    return width, height, DECODED_CHANNELS, 'video', max(frames, 1)
+
+def _probe_still(source):
+    """Header read of a still or multi-page image (path or file object) via PIL"""
+    try:
+        with warnings.catch_warnings():
+            # Size is checked against our own limit instead
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(source) as img:
+                width, height = img.size
+                channels = len(img.getbands())
+                image_format = img.format
+                frames = getattr(img, 'n_frames', 1)
+                if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                    width, height = height, width
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(f"Image too large: {e}")
+    except Exception:
+        raise ImageRejected("Not a readable image")
+    return width, height, channels, image_format, frames
+
+def probe_image(image_path):
+    """Read dimensions, channels and format from the header; raises ImageRejected.
+
+    ``width`` and ``height`` respect the EXIF orientation tag, like cv2.imread.
+    ``decoded_bytes`` is the size of the BGR frame a full decode allocates;
+    multi-frame inputs are decoded one frame at a time, so it covers one.
+    """
+    if is_video(image_path):
+        return _probe_result(*probe_video(image_path))
+    return _probe_result(*_probe_still(image_path))
+
+def probe_buffer(data):
+    """probe_image for an encoded image held in memory (videos are not supported)"""
+    return _probe_result(*_probe_still(io.BytesIO(data)))
+
+def _probe_result(width, height, channels, image_format, frames):
+    megapixels = width * height / 1e6
+    if megapixels > MAX_IMAGE_MEGAPIXELS:
+        raise ImageRejected(f"Image too large: {width}x{height} "
+                            f"({megapixels:.0f} MP, limit {MAX_IMAGE_MEGAPIXELS} MP)")
+    return {
+        'width': width,
+        'height': height,
+        'channels': channels,
+        'format': image_format,
+        'frames': frames,
+        'megapixels': round(megapixels, 2),
+        'decoded_bytes': width * height * DECODED_CHANNELS,
+    }
+
+def save_probe(image_path):
+    """Probe an upload and store the result next to it; returns the probe.
+
+    A rejected upload is deleted before ImageRejected propagates.
+    """
+    try:
+        probe = probe_image(image_path)
+    except ImageRejected:
+        remove_probe(image_path)
+        try:
+            os.remove(image_path)
+        except OSError:
+            pass
+        raise
+    sidecar = probe_path(image_path)
+    tmp_path = sidecar + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(probe, f)
+    os.replace(tmp_path, sidecar)
+    return probe
+
+def load_probe(image_path):
+    """Stored probe for ``image_path``, probing the header if there is none.
+
+    Raises ImageRejected like probe_image.
+    """
+    try:
+        with open(probe_path(image_path)) as f:
+            probe = json.load(f)
+    except (OSError, ValueError):
+        return probe_image(image_path)
+    # The limit may have been lowered since the upload was probed
+    if probe['megapixels'] > MAX_IMAGE_MEGAPIXELS:
+        raise ImageRejected(f"Image too large: {probe['width']}x{probe['height']} "
+                            f"({probe['megapixels']:.0f} MP, limit {MAX_IMAGE_MEGAPIXELS} MP)")
+    return probe
+
+def remove_probe(image_path):
+    try:
+        os.remove(probe_path(image_path))
+    except OSError:
+        pass
@@ -0,0 +1,99 @@
+"""Background janitor for the web apps: expiry of old data and disk-quota eviction.
+
+Cleanup used to run inside app_cloud.py's / handler on every page load. The janitor
+runs on a daemon thread instead, once per interval. Every worker starts
+one, but a non-blocking file lock lets only one of them sweep at a time.
+
+When the temp folders exceed their byte quota, files are evicted least
+recently used first (by mtime, which is refreshed whenever a file is reused
+or downloaded). Outputs go before uploads, since they can be recreated.
+"""
+import os
+import threading
+import time
+
+from content_store import file_lock
+
+
+def iter_files(folder):
+    """Yield (path, size, mtime) for every file under ``folder``"""
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_size, st.st_mtime
+
+def disk_usage(folders):
+    """Total bytes used by files under ``folders``"""
+    return sum(size for folder in folders for _, size, _ in iter_files(folder))
+
+def remove_stale(folder, max_age, now=None):
+    """Delete files in ``folder`` (not recursive) older than ``max_age`` seconds"""
+    now = time.time() if now is None else now
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def evict_lru(tiers, usage, quota, grace, now=None):
+    """Evict files until ``usage`` bytes fit in ``quota``; returns bytes freed.
+
+    ``tiers`` is a list of ``(candidates, evict)``: ``candidates`` yields
+    (path, size, mtime) and ``evict(path)`` deletes one entry and returns the
+    bytes it freed. Each tier is evicted oldest first before the next one is
+    touched. Files used within the last ``grace`` seconds are kept.
+    """
+    now = time.time() if now is None else now
+    freed = 0
+    for candidates, evict in tiers:
+        for path, size, mtime in sorted(candidates, key=lambda c: c[2]):
+            if usage - freed <= quota:
+                return freed
+            if now - mtime < grace:
+                continue
+            freed += evict(path)
+    return freed
+
+
+class Janitor:
+    """Runs ``sweep()`` every ``interval`` seconds on one worker at a time"""
+
+    def __init__(self, sweep, interval, lock_path):
+        self.sweep = sweep
+        self.interval = interval
+        self.lock_path = lock_path
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start this process's janitor thread if it is not running (cheap to call per request)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='janitor', daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Janitor sweep failed: {e}")
+
+    def run_once(self):
+        """Sweep now unless another worker is already sweeping"""
+        with file_lock(self.lock_path, blocking=False) as locked:
+            if not locked:
+                return False
+            self.sweep()
+            return True
@@ -0,0 +1,461 @@
+"""Background /process jobs with progress stored in SQLite.
+
+Job state lives in a WAL-mode SQLite file rather than in process memory, so
+any gunicorn worker can answer status and cancel requests for a job that a
+different worker accepted. A job's items and options are stored with it,
+and the work itself runs on one background thread per worker, which claims
+queued jobs under a lease it keeps renewing.
+
+When a worker exits (a max_requests recycle, a restart) its unfinished jobs
+are marked interrupted; when it dies without exiting cleanly, its leases
+run out. Either way another worker claims the job and resumes it after the
+last recorded result, so a long batch survives the worker that accepted it.
+
+Progress can be followed as Server-Sent Events (iter_job_events): each
+image's result is sent as soon as it is recorded. Each stream holds one of
+its gunicorn worker's threads (gthread workers), so streams end after a
+minute; browsers reconnect on their own and resume after the last event ID
+they saw.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+CANCELLED = 'cancelled'
+FAILED = 'failed'            # processing raised, or the job kept killing its worker
+INTERRUPTED = 'interrupted'  # worker exited before the job finished; another one resumes it
+FINISHED_STATES = (COMPLETED, CANCELLED, FAILED)
+
+# Job runner
+JOB_LEASE_SECONDS = 60     # A running job whose lease is this old is claimed by another worker
+JOB_CLAIM_INTERVAL = 5     # Seconds between lease renewals and looks for orphaned jobs
+MAX_JOB_TAKEOVERS = 3      # Expired leases taken over before a job that keeps killing its worker fails
+
+# Server-Sent Events
+EVENT_POLL_INTERVAL = 0.25  # Seconds between checks for new results
+EVENT_KEEPALIVE = 15        # Seconds of silence before a keep-alive comment
+EVENT_STREAM_SECONDS = 60   # Longest single stream (below the gunicorn timeout)
+EVENT_RETRY_MS = 1000       # Client reconnect delay
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    items TEXT NOT NULL DEFAULT '[]',
+    options TEXT NOT NULL DEFAULT '{}',
+    lease_until REAL,
+    takeovers INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+# Columns added after the first release, for job files created before them
+ADDED_COLUMNS = {
+    'items': "TEXT NOT NULL DEFAULT '[]'",
+    'options': "TEXT NOT NULL DEFAULT '{}'",
+    'lease_until': 'REAL',
+    'takeovers': 'INTEGER NOT NULL DEFAULT 0',
+    'lease_owner': 'TEXT',
+}
+
+
+_stores = []  # every JobStore opened in this process, for the job runner and shutdown_jobs()
+_lease = {'pid': None, 'owner': None}
+_lease_lock = threading.Lock()
+
+
+def _lease_owner():
+    """This process's lease token: its pid plus a random part, new after a fork.
+
+    The random part keeps a process that reuses a dead worker's pid from
+    renewing or finishing that worker's jobs.
+    """
+    with _lease_lock:
+        if _lease['pid'] != os.getpid():
+            _lease['pid'] = os.getpid()
+            _lease['owner'] = f'{os.getpid()}:{uuid.uuid4().hex}'
+        return _lease['owner']
+
+
+class JobStore:
+    """Job records and per-image results shared by every worker process
+
+    The function that does a job's work is registered with the ``runner``
+    decorator; it is called as ``process_items(items, owner, options)`` and
+    must yield one result per item, in input order.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.process_items = None
+        _stores.append(self)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            existing = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if existing:
+                for column, definition in ADDED_COLUMNS.items():
+                    if column not in existing:
+                        conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+            conn.executescript(SCHEMA)
+
+    def runner(self, process_items):
+        """Decorator registering the function that processes this store's jobs"""
+        self.process_items = process_items
+        return process_items
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, items, owner=None, options=None):
+        """Register a new queued job for ``items`` and return its ID
+
+        ``items`` and ``options`` must be JSON-serializable; they are what
+        a worker resuming the job passes to the runner.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, owner, status, total, items, options, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, owner, QUEUED, len(items), json.dumps(items), json.dumps(options or {}),
+                 now, now))
+        return job_id
+
+    def claim(self, lease=JOB_LEASE_SECONDS):
+        """Take the oldest job no live worker is running, for this process.
+
+        Queued and interrupted jobs are claimable, and so are running jobs
+        whose lease has expired. Returns the job with its ``items``,
+        ``options`` and ``completed`` count, or None.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE status IN (?, ?) OR (status = ? AND lease_until < ?) '
+                'ORDER BY created_at LIMIT 1',
+                (QUEUED, INTERRUPTED, RUNNING, now)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            # An expired lease means the worker died mid-job, possibly because of the job
+            takeover = row['status'] == RUNNING
+            if takeover and row['takeovers'] >= MAX_JOB_TAKEOVERS:
+                conn.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?',
+                             (FAILED, now, row['id']))
+                conn.execute('COMMIT')
+                return self.claim(lease)
+            conn.execute(
+                'UPDATE jobs SET status = ?, pid = ?, lease_owner = ?, lease_until = ?, '
+                'takeovers = takeovers + ?, updated_at = ? WHERE id = ?',
+                (RUNNING, os.getpid(), _lease_owner(), now + lease, int(takeover), now, row['id']))
+            conn.execute('COMMIT')
+        return {
+            'job_id': row['id'],
+            'owner': row['owner'],
+            'completed': row['completed'],
+            'items': json.loads(row['items']),
+            'options': json.loads(row['options']),
+        }
+
+    def renew_leases(self, lease=JOB_LEASE_SECONDS):
+        """Extend the lease on every job this process is running"""
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET lease_until = ? WHERE lease_owner = ? AND status = ?',
+                         (time.time() + lease, _lease_owner(), RUNNING))
+
+    def set_status(self, job_id, status):
+        """Finish a job this process is running; False if it is no longer its job"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET status = ?, updated_at = ? '
+                'WHERE id = ? AND lease_owner = ? AND status = ?',
+                (status, time.time(), job_id, _lease_owner(), RUNNING))
+            return cursor.rowcount > 0
+
+    def add_result(self, job_id, index, result):
+        """Store one image's result and record the progress.
+
+        Returns False, storing nothing, if this process no longer runs the
+        job (it was interrupted and claimed elsewhere).
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute(
+                'UPDATE jobs SET completed = ?, updated_at = ? '
+                'WHERE id = ? AND lease_owner = ? AND status = ?',
+                (index + 1, time.time(), job_id, _lease_owner(), RUNNING))
+            if cursor.rowcount:
+                conn.execute('INSERT OR REPLACE INTO job_results (job_id, idx, result) VALUES (?, ?, ?)',
+                             (job_id, index, json.dumps(result)))
+            conn.execute('COMMIT')
+            return cursor.rowcount > 0
+
+    def request_cancel(self, job_id):
+        """Ask a running job to stop after its current image; False if already finished"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'UPDATE jobs SET cancel_requested = 1, updated_at = ? '
+                'WHERE id = ? AND status NOT IN (?, ?, ?)',
+                (time.time(), job_id) + FINISHED_STATES)
+            return cursor.rowcount > 0
+
+    def is_cancel_requested(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    def get(self, job_id, include_results=True):
+        """Return the job as a dict (with results in input order), or None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = {
+                'job_id': row['id'],
+                'owner': row['owner'],
+                'status': row['status'],
+                'total': row['total'],
+                'completed': row['completed'],
+                'cancel_requested': bool(row['cancel_requested']),
+                'created_at': row['created_at'],
+                'updated_at': row['updated_at'],
+            }
+            if include_results:
+                job['results'] = [
+                    json.loads(r['result']) for r in conn.execute(
+                        'SELECT result FROM job_results WHERE job_id = ? ORDER BY idx', (job_id,))
+                ]
+        return job
+
+    def results_since(self, job_id, start=0):
+        """``(index, result)`` pairs recorded for the job from ``start`` on, in input order"""
+        with self._connect() as conn:
+            return [(r['idx'], json.loads(r['result'])) for r in conn.execute(
+                'SELECT idx, result FROM job_results WHERE job_id = ? AND idx >= ? ORDER BY idx',
+                (job_id, start))]
+
+    def interrupt_running(self):
+        """Release the unfinished jobs this process runs for another worker"""
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, lease_owner = NULL, lease_until = NULL, updated_at = ? '
+                'WHERE lease_owner = ? AND status = ?',
+                (INTERRUPTED, time.time(), _lease_owner(), RUNNING))
+
+    def prune(self, max_age):
+        """Delete jobs finished more than ``max_age`` seconds ago, with their results"""
+        cutoff = time.time() - max_age
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'DELETE FROM job_results WHERE job_id IN '
+                '(SELECT id FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?)',
+                FINISHED_STATES + (cutoff,))
+            cursor = conn.execute('DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?',
+                                  FINISHED_STATES + (cutoff,))
+            conn.execute('COMMIT')
+            return cursor.rowcount
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_claim_scheduled = False
+_shut_down_pid = None  # Set by shutdown_jobs; no new runner is started in this process
+
+
+def _get_executor():
+    """One job runner thread per worker process (recreated after fork)
+
+    Starting it also starts the thread that renews this process's leases
+    and looks for jobs left behind by other workers.
+    """
+    global _executor, _executor_pid, _claim_scheduled
+    with _executor_lock:
+        if _shut_down_pid == os.getpid():
+            raise RuntimeError("The job runner has been shut down")
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job')
+            _executor_pid = os.getpid()
+            _claim_scheduled = False
+            threading.Thread(target=_watch_jobs, name='job-watch', daemon=True).start()
+        return _executor
+
+def start_job_runner():
+    """Make sure this process runs jobs, including ones other workers left unfinished"""
+    if _executor is None or _executor_pid != os.getpid():
+        _schedule_claim()
+
+def run_on_job_thread(fn, *args):
+    """Run ``fn`` on this process's job runner thread; returns its Future"""
+    return _get_executor().submit(fn, *args)
+
+def _schedule_claim():
+    """Have the job thread claim and run whatever jobs it can (at most one request queued)"""
+    global _claim_scheduled
+    try:
+        executor = _get_executor()
+        with _executor_lock:
+            if _claim_scheduled:
+                return
+            _claim_scheduled = True
+        executor.submit(_run_claimable_jobs)
+    except RuntimeError:
+        pass  # Shut down by worker_exit; another worker claims the job
+
+def _run_claimable_jobs():
+    global _claim_scheduled
+    with _executor_lock:
+        _claim_scheduled = False
+    for store in list(_stores):
+        if store.process_items is None:
+            continue
+        while _executor_pid == os.getpid() and _executor is not None:
+            job = store.claim()
+            if job is None:
+                break
+            run_job(store, job)
+
+def _watch_jobs():
+    pid = os.getpid()
+    while _executor is not None and _executor_pid == pid:
+        time.sleep(JOB_CLAIM_INTERVAL)
+        for store in list(_stores):
+            try:
+                store.renew_leases()
+            except sqlite3.Error:
+                pass
+        if _executor is not None and _executor_pid == pid:
+            _schedule_claim()
+
+
+def run_job(store, job):
+    """Record each result the store's runner yields for a claimed job, honouring cancellation.
+
+    Work starts after the last result already recorded, so a job resumed
+    from an exited worker does not repeat finished images.
+    """
+    job_id, items, start = job['job_id'], job['items'], job['completed']
+    remaining = len(items) - start
+    metrics.add_gauge('crop_queue_depth', remaining)
+    results = None
+    try:
+        if store.is_cancel_requested(job_id):
+            store.set_status(job_id, CANCELLED)
+            return
+        results = store.process_items(items[start:], job['owner'], job['options'])
+        for index, result in enumerate(results, start):
+            if not store.add_result(job_id, index, result):
+                return  # Interrupted and handed to another worker
+            remaining -= 1
+            metrics.add_gauge('crop_queue_depth', -1)
+            if store.is_cancel_requested(job_id) and index + 1 < len(items):
+                store.set_status(job_id, CANCELLED)
+                return
+        store.set_status(job_id, COMPLETED)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        store.set_status(job_id, FAILED)
+    finally:
+        metrics.add_gauge('crop_queue_depth', -remaining)
+        if results is not None and hasattr(results, 'close'):
+            results.close()
+
+
+def submit_job(store, items, owner=None, options=None):
+    """Create a job for ``items`` and have a job thread pick it up; returns the job ID
+
+    The store's runner is called with ``items``, ``owner`` and ``options``.
+    """
+    job_id = store.create(list(items), owner=owner, options=options)
+    _schedule_claim()
+    return job_id
+
+
+def format_event(event, data, event_id=None):
+    """One Server-Sent Event with a JSON payload"""
+    lines = [] if event_id is None else [f'id: {event_id}']
+    lines += [f'event: {event}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+def iter_job_events(store, job_id, start=0, poll_interval=EVENT_POLL_INTERVAL,
+                    keepalive=EVENT_KEEPALIVE, max_seconds=EVENT_STREAM_SECONDS):
+    """Yield a job's progress as Server-Sent Events, starting with result ``start``.
+
+    Each result is a ``result`` event whose ID is its index. When the job
+    finishes, a ``done`` event carries its final status. A stream that would
+    outlive ``max_seconds`` just ends; the client reconnects with the
+    Last-Event-ID header and continues from the next result.
+    """
+    deadline = time.monotonic() + max_seconds
+    last_sent = time.monotonic()
+    yield f'retry: {EVENT_RETRY_MS}\n\n'
+    while True:
+        # Status first: once it reads finished, every result is already stored
+        job = store.get(job_id, include_results=False)
+        if job is None:
+            return
+        for index, result in store.results_since(job_id, start):
+            yield format_event('result', result, index)
+            start, last_sent = index + 1, time.monotonic()
+        if job['status'] in FINISHED_STATES:
+            yield format_event('done', {'job_id': job_id, 'status': job['status'],
+                                        'total': job['total'], 'completed': job['completed']})
+            return
+        if time.monotonic() >= deadline:
+            return
+        if time.monotonic() - last_sent >= keepalive:
+            yield ': keep-alive\n\n'
+            last_sent = time.monotonic()
+        time.sleep(poll_interval)
+
+
+def shutdown_jobs():
+    """Stop this worker's job runner and hand its unfinished jobs to other workers.
+
+    Called from the gunicorn worker_exit hook; results already recorded stay
+    available to the client, and whichever worker claims a job next carries
+    on from there.
+    """
+    global _executor, _shut_down_pid
+    with _executor_lock:
+        executor, _executor = _executor, None
+        _shut_down_pid = os.getpid()
+    if executor is not None and _executor_pid == os.getpid():
+        executor.shutdown(wait=False, cancel_futures=True)
+    for store in _stores:
+        store.interrupt_running()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Load generator for the HTTP endpoints
+
+Replays user sessions against a running instance of app.py or app_cloud.py
+(e.g. under gunicorn) at a fixed arrival rate. Each session uploads a few
+synthetic portraits, crops them and downloads a result. Sessions arrive as a
+Poisson process, independent of how fast the server answers, so an
+overloaded server shows up as rising latency and errors instead of a slower
+client. Reports p50/p95/p99 latency and error rate per endpoint, plus
+throughput, so worker-count and timeout changes can be measured.
+
+Flows:
+    jobs    POST /upload, POST /process, poll the job until it finishes, GET /download
+    wait    POST /upload, POST /process with "wait": true, GET /download
+    stream  POST /upload_and_process, GET /download (app_cloud.py only)
+
+Usage:
+    gunicorn -c gunicorn.conf.py app_cloud:app &
+    python loadtest.py --url http://localhost:10000 --rate 2 --duration 60
+    python loadtest.py --flow wait --rate 5 --images 3 --json run.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import requests
+
+from benchmark import make_portrait
+from jobs import COMPLETED, FINISHED_STATES
+
+FLOWS = ['jobs', 'wait', 'stream']
+ENDPOINTS = ['upload', 'process', 'job', 'download', 'session']
+PERCENTILES = (50, 95, 99)
+UPLOAD_FOLDERS = {'app': 'uploads', 'app_cloud': 'temp_uploads'}
+
+
+def make_images(count, width, height):
+    """JPEG bytes of ``count`` different synthetic portraits"""
+    images = []
+    for seed in range(count):
+        ok, buffer = cv2.imencode('.jpg', make_portrait(width, height, seed),
+                                  [cv2.IMWRITE_JPEG_QUALITY, 90])
+        images.append(buffer.tobytes())
+    return images
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Thread-safe latency samples and error counts per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {name: [] for name in ENDPOINTS}
+        self.errors = {name: {} for name in ENDPOINTS}
+        self.images_cropped = 0
+        self.images_failed = 0
+        self.late_starts = 0
+
+    def record(self, endpoint, seconds, error=None):
+        with self._lock:
+            self.samples[endpoint].append(seconds)
+            if error is not None:
+                self.errors[endpoint][error] = self.errors[endpoint].get(error, 0) + 1
+
+    def count_results(self, results):
+        with self._lock:
+            for result in results:
+                if result.get('success'):
+                    self.images_cropped += 1
+                else:
+                    self.images_failed += 1
+
+    def summary(self, elapsed):
+        """Per-endpoint latency percentiles (ms), error rates and overall throughput"""
+        endpoints = {}
+        with self._lock:
+            for name in ENDPOINTS:
+                values = sorted(self.samples[name])
+                if not values:
+                    continue
+                errors = sum(self.errors[name].values())
+                endpoints[name] = {
+                    'count': len(values),
+                    'errors': errors,
+                    'error_rate': round(errors / len(values), 4),
+                    'error_kinds': dict(self.errors[name]),
+                    'mean_ms': round(1000 * sum(values) / len(values), 1),
+                    **{f'p{p}_ms': round(1000 * percentile(values, p), 1) for p in PERCENTILES},
+                    'max_ms': round(1000 * values[-1], 1),
+                }
+            sessions = endpoints.get('session', {}).get('count', 0)
+            requests_sent = sum(e['count'] for name, e in endpoints.items() if name != 'session')
+            return {
+                'elapsed_s': round(elapsed, 2),
+                'sessions_per_s': round(sessions / elapsed, 3) if elapsed else None,
+                'requests_per_s': round(requests_sent / elapsed, 3) if elapsed else None,
+                'images_per_s': round(self.images_cropped / elapsed, 3) if elapsed else None,
+                'images_cropped': self.images_cropped,
+                'images_failed': self.images_failed,
+                'late_starts': self.late_starts,
+                'endpoints': endpoints,
+            }
+
+
+class SessionFailed(Exception):
+    """A step failed; the rest of the session is skipped"""
+
+
+def timed_request(recorder, endpoint, session, method, url, timeout, **kwargs):
+    """Send one request and record its latency; raises SessionFailed on any error"""
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=timeout, **kwargs)
+    except requests.Timeout:
+        recorder.record(endpoint, time.perf_counter() - start, 'timeout')
+        raise SessionFailed(endpoint)
+    except requests.RequestException as e:
+        recorder.record(endpoint, time.perf_counter() - start, type(e).__name__)
+        raise SessionFailed(endpoint)
+    elapsed = time.perf_counter() - start
+    if response.status_code >= 400:
+        recorder.record(endpoint, elapsed, f'HTTP {response.status_code}')
+        raise SessionFailed(endpoint)
+    recorder.record(endpoint, elapsed)
+    return response
+
+def upload_parts(images, session_id, unique):
+    """Multipart ``files[]`` for one session's uploads"""
+    parts = []
+    for index, data in enumerate(images):
+        if unique:
+            # Bytes after the JPEG end marker are ignored by decoders but
+            # change the content hash, so app_cloud cannot reuse a cached crop
+            data += os.urandom(16)
+        parts.append(('files[]', (f'load_{session_id}_{index}.jpg', data, 'image/jpeg')))
+    return parts
+
+def upload_paths(files, upload_folder):
+    """/process image paths for the names /upload returned"""
+    return [f if os.sep in f or '/' in f else f'{upload_folder}/{f}' for f in files]
+
+def run_session(args, recorder, images, session_id):
+    """One user: upload, crop and download, recording each step"""
+    base = args.url.rstrip('/')
+    picked = random.sample(images, min(args.images, len(images)))
+    start = time.perf_counter()
+    error = None
+    with requests.Session() as http:
+        try:
+            if args.flow == 'stream':
+                response = timed_request(recorder, 'process', http, 'POST',
+                                         f'{base}/upload_and_process', args.timeout,
+                                         files=upload_parts(picked, session_id, args.unique))
+                results = response.json()['results']
+            else:
+                response = timed_request(recorder, 'upload', http, 'POST', f'{base}/upload',
+                                         args.timeout,
+                                         files=upload_parts(picked, session_id, args.unique))
+                paths = upload_paths(response.json().get('files', []), args.upload_folder)
+                body = {'image_paths': paths, 'wait': args.flow == 'wait'}
+                response = timed_request(recorder, 'process', http, 'POST', f'{base}/process',
+                                         args.timeout, json=body)
+                if args.flow == 'wait':
+                    results = response.json()['results']
+                else:
+                    results = wait_for_job(args, recorder, http, base + response.json()['status_url'])
+
+            recorder.count_results(results)
+            outputs = [r['output'] for r in results if r.get('success') and r.get('output')]
+            if not outputs:
+                raise SessionFailed('no output')
+            timed_request(recorder, 'download', http, 'GET',
+                          f'{base}/download/{os.path.basename(outputs[0])}', args.timeout)
+        except SessionFailed as e:
+            error = str(e)
+        except (ValueError, KeyError) as e:
+            error = f'bad response: {e}'
+    recorder.record('session', time.perf_counter() - start, error)
+
+def wait_for_job(args, recorder, http, status_url):
+    """Poll a /process job until it finishes; records submit-to-finish time as 'job'"""
+    start = time.perf_counter()
+    deadline = start + args.job_timeout
+    while True:
+        try:
+            response = http.get(status_url, timeout=args.timeout)
+            response.raise_for_status()
+            job = response.json()
+        except (requests.RequestException, ValueError) as e:
+            recorder.record('job', time.perf_counter() - start, type(e).__name__)
+            raise SessionFailed('job')
+        if job['status'] in FINISHED_STATES:
+            error = None if job['status'] == COMPLETED else job['status']
+            recorder.record('job', time.perf_counter() - start, error)
+            if error:
+                raise SessionFailed('job')
+            return job['results']
+        if time.perf_counter() > deadline:
+            recorder.record('job', time.perf_counter() - start, 'timeout')
+            raise SessionFailed('job')
+        time.sleep(args.poll_interval)
+
+def run_load(args, images):
+    """Start sessions at Poisson arrival times for ``args.duration`` seconds"""
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    next_arrival = start
+    session_id = 0
+    with ThreadPoolExecutor(max_workers=args.max_sessions) as pool:
+        while next_arrival - start < args.duration:
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.1:
+                # The client fell behind schedule; the rate is no longer what was asked for
+                recorder.late_starts += 1
+            pool.submit(run_session, args, recorder, images, session_id)
+            session_id += 1
+            next_arrival += rng.expovariate(args.rate)
+    return recorder.summary(time.perf_counter() - start)
+
+def print_report(summary, args):
+    print(f"\n{args.flow} flow, {args.rate} sessions/s for {args.duration}s, "
+          f"{args.images} images of {args.width}x{args.height} per session")
+    header = f"{'endpoint':<10}{'count':>7}{'errors':>8}{'err %':>8}" + \
+        ''.join(f"{f'p{p} ms':>10}" for p in PERCENTILES) + f"{'max ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, stats in summary['endpoints'].items():
+        print(f"{name:<10}{stats['count']:>7}{stats['errors']:>8}{100 * stats['error_rate']:>8.1f}"
+              + ''.join(f"{stats[f'p{p}_ms']:>10.1f}" for p in PERCENTILES)
+              + f"{stats['max_ms']:>10.1f}")
+    print(f"\nThroughput: {summary['sessions_per_s']} sessions/s, "
+          f"{summary['requests_per_s']} requests/s, {summary['images_per_s']} images/s "
+          f"({summary['images_cropped']} cropped, {summary['images_failed']} failed)")
+    for name, stats in summary['endpoints'].items():
+        if stats['error_kinds']:
+            kinds = ', '.join(f"{kind}: {n}" for kind, n in stats['error_kinds'].items())
+            print(f"  {name} errors: {kinds}")
+    if summary['late_starts']:
+        print(f"⚠️  {summary['late_starts']} sessions started late; raise --max-sessions")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the HTTP endpoints")
+    parser.add_argument('--url', default='http://localhost:10000',
+                        help="Base URL of the running app (gunicorn.conf.py binds port 10000)")
+    parser.add_argument('--app', choices=sorted(UPLOAD_FOLDERS), default='app_cloud',
+                        help="Which app is running (sets where /upload stores files)")
+    parser.add_argument('--flow', choices=FLOWS, default='jobs', help="Request sequence per session")
+    parser.add_argument('--rate', type=float, default=1.0, help="New sessions per second")
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help="Seconds to keep starting sessions")
+    parser.add_argument('--images', type=int, default=3, help="Images uploaded per session")
+    parser.add_argument('--width', type=int, default=1732, help="Synthetic image width")
+    parser.add_argument('--height', type=int, default=1155, help="Synthetic image height")
+    parser.add_argument('--variants', type=int, default=8, help="Different portraits to draw from")
+    parser.add_argument('--unique', action=argparse.BooleanOptionalAction, default=True,
+                        help="Make every upload's bytes unique to defeat the output cache")
+    parser.add_argument('--max-sessions', type=int, default=64,
+                        help="Most sessions in progress at once (client threads)")
+    parser.add_argument('--timeout', type=float, default=120.0,
+                        help="Per-request timeout in seconds (match gunicorn's timeout)")
+    parser.add_argument('--job-timeout', type=float, default=600.0,
+                        help="Longest wait for a /process job to finish")
+    parser.add_argument('--poll-interval', type=float, default=0.5,
+                        help="Seconds between job status polls (the resolution of job latency)")
+    parser.add_argument('--seed', type=int, default=0, help="Arrival-time random seed")
+    parser.add_argument('--json', metavar='FILE', help="Also write the summary to a JSON file")
+    args = parser.parse_args(argv)
+    if args.rate <= 0 or args.duration <= 0 or args.images < 1 or args.variants < 1:
+        parser.error("--rate, --duration, --images and --variants must be positive")
+    args.upload_folder = UPLOAD_FOLDERS[args.app]
+
+    print(f"Drawing {args.variants} synthetic portraits...")
+    images = make_images(args.variants, args.width, args.height)
+    print(f"Running {args.flow} sessions against {args.url}...")
+    summary = run_load(args, images)
+    print_report(summary, args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(summary, settings={k: v for k, v in vars(args).items()}), f, indent=2)
+        print(f"Summary written to {args.json}")
+    return 1 if summary['endpoints'].get('session', {}).get('errors') else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,317 @@
+"""Low-overhead Prometheus-style metrics shared across worker processes.
+
+Every process (gunicorn workers and crop pool processes alike) records into
+plain in-memory dicts under a lock, which costs well under a microsecond per
+update. A daemon thread writes a snapshot of the process's metrics to
+METRICS_FOLDER at most once per FLUSH_INTERVAL, and /metrics merges every
+snapshot into the Prometheus text format. Counters and histograms are summed
+across processes; gauges are reported per live process with a ``pid`` label.
+Snapshots of processes that have exited (recycled workers, old pool
+processes) are folded into one running total and deleted, so the folder and
+the cost of a scrape stay bounded.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import METRICS_FOLDER
+
+FLUSH_INTERVAL = 1.0  # Seconds between snapshot writes
+EXITED_FILE = 'exited.json'   # Counters and histograms of processes that have exited
+FOLD_LOCK_FILE = 'fold.lock'  # Held while exited snapshots are folded in
+FOLD_LOCK_STALE = 30          # Seconds after which a leftover fold lock is ignored
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRICS = {
+    'crop_upload_bytes_total': ('counter', 'Bytes received by upload endpoints'),
+    'crop_stage_seconds': ('histogram', 'Time spent in each pipeline stage'),
+    'crop_detections_total': ('counter', 'Face detection outcomes (miss = center crop fallback)'),
+    'crop_detection_store_total': ('counter', 'Saved-detection lookups by outcome (miss = detector runs)'),
+    'crop_images_total': ('counter', 'Images processed by outcome'),
+    'crop_queue_depth': ('gauge', 'Images accepted by /process jobs but not yet finished'),
+    'crop_in_flight_images': ('gauge', 'Images submitted to the crop pool and not yet returned'),
+    'crop_in_flight_bytes': ('gauge', 'Decoded image bytes admitted to the crop pool and not yet returned'),
+    'crop_startup_seconds': ('gauge', 'Process start-up time by phase (import, warmup, detector)'),
+    'crop_first_request_seconds': ('gauge', 'Latency of the first request served by a web worker'),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [per-bucket counts..., sum, count]
+_state = {'pid': None, 'started': None, 'dirty': False}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def _touch():
+    """Mark metrics changed and make sure this process has a flusher thread"""
+    _state['dirty'] = True
+    if _state['pid'] != os.getpid():
+        _state['pid'] = os.getpid()
+        _state['started'] = time.time()  # Tells this process apart from an earlier one with its pid
+        threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+def inc(name, value=1, **labels):
+    """Add ``value`` to a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _touch()
+
+def add_gauge(name, value, **labels):
+    """Move a gauge for this process up or down by ``value``"""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+        _touch()
+
+def set_gauge(name, value, **labels):
+    """Set a gauge for this process"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+        _touch()
+
+def observe(name, value, **labels):
+    """Record one histogram observation"""
+    key = _key(name, labels)
+    with _lock:
+        buckets = _histograms.get(key)
+        if buckets is None:
+            buckets = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+                break
+        buckets[-2] += value
+        buckets[-1] += 1
+        _touch()
+
+@contextmanager
+def timed(stage):
+    """Time a block into crop_stage_seconds{stage=...}"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('crop_stage_seconds', time.perf_counter() - start, stage=stage)
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'started': _state['started'],
+            'counters': [[n, list(l), v] for (n, l), v in _counters.items()],
+            'gauges': [[n, list(l), v] for (n, l), v in _gauges.items()],
+            'histograms': [[n, list(l), list(b)] for (n, l), b in _histograms.items()],
+        }
+
+def flush():
+    """Write this process's snapshot to METRICS_FOLDER"""
+    _state['dirty'] = False
+    snapshot = _snapshot()
+    os.makedirs(METRICS_FOLDER, exist_ok=True)
+    path = os.path.join(METRICS_FOLDER, f"{snapshot['pid']}.json")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+def _flush_loop():
+    pid = os.getpid()
+    while _state['pid'] == pid:
+        time.sleep(FLUSH_INTERVAL)
+        if _state['dirty']:
+            try:
+                flush()
+            except OSError:
+                pass
+
+def _flush_at_exit():
+    if _state['pid'] == os.getpid() and _state['dirty']:
+        try:
+            flush()
+        except OSError:
+            pass
+
+atexit.register(_flush_at_exit)
+
+def reset_metrics_folder():
+    """Remove snapshots from previous runs (called once when the server starts)"""
+    if os.path.isdir(METRICS_FOLDER):
+        for filename in os.listdir(METRICS_FOLDER):
+            try:
+                os.remove(os.path.join(METRICS_FOLDER, filename))
+            except OSError:
+                pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _snapshot_id(snapshot):
+    return f"{snapshot['pid']}:{snapshot.get('started')}"
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _merge_into(totals, snapshot):
+    """Add a snapshot's counters and histograms to ``totals`` (same list layout)"""
+    counters = {(n, tuple(map(tuple, l))): v for n, l, v in totals['counters']}
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    histograms = {(n, tuple(map(tuple, l))): b for n, l, b in totals['histograms']}
+    for name, labels, buckets in snapshot['histograms']:
+        merged = histograms.setdefault((name, tuple(map(tuple, labels))), [0] * len(buckets))
+        for i, value in enumerate(buckets):
+            merged[i] += value
+    totals['counters'] = [[n, list(l), v] for (n, l), v in counters.items()]
+    totals['histograms'] = [[n, list(l), b] for (n, l), b in histograms.items()]
+
+def _fold_exited(dead_files):
+    """Move the snapshots in ``dead_files`` into EXITED_FILE and delete them.
+
+    Only one process folds at a time (an exclusive lock file); a scrape that
+    finds the lock taken leaves the work to the next one. Each folded
+    snapshot's ID is recorded in the totals before its file is deleted, so a
+    concurrent reader that still sees the file never counts it twice.
+    """
+    lock_path = os.path.join(METRICS_FOLDER, FOLD_LOCK_FILE)
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > FOLD_LOCK_STALE:
+                os.remove(lock_path)  # Left by a process that died while folding
+        except OSError:
+            pass
+        return
+    except OSError:
+        return
+    try:
+        exited_path = os.path.join(METRICS_FOLDER, EXITED_FILE)
+        totals = _read_json(exited_path) or {'folded': {}, 'counters': [], 'histograms': []}
+        # Forget folded IDs whose files are gone; their pids may be reused
+        totals['folded'] = {sid: name for sid, name in totals['folded'].items()
+                            if os.path.exists(os.path.join(METRICS_FOLDER, name))}
+        folded = []
+        for filename in dead_files:
+            snapshot = _read_json(os.path.join(METRICS_FOLDER, filename))
+            if snapshot is None or _snapshot_id(snapshot) in totals['folded']:
+                continue
+            _merge_into(totals, snapshot)
+            totals['folded'][_snapshot_id(snapshot)] = filename
+            folded.append(filename)
+        if folded:
+            _write_json(exited_path, totals)
+        for filename in folded:
+            try:
+                os.remove(os.path.join(METRICS_FOLDER, filename))
+            except OSError:
+                pass
+    except (OSError, KeyError, TypeError, ValueError):
+        pass
+    finally:
+        os.close(fd)
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+def _load_snapshots():
+    """Snapshots of live processes, plus the folded totals of exited ones"""
+    snapshots = {}
+    dead_files = []
+    if os.path.isdir(METRICS_FOLDER):
+        for filename in os.listdir(METRICS_FOLDER):
+            if not filename.endswith('.json') or filename == EXITED_FILE:
+                continue
+            snapshot = _read_json(os.path.join(METRICS_FOLDER, filename))
+            try:
+                pid = snapshot['pid']
+            except (TypeError, KeyError):
+                continue
+            snapshot['alive'] = _pid_alive(pid)
+            if not snapshot['alive']:
+                dead_files.append(filename)
+            snapshots[_snapshot_id(snapshot)] = snapshot
+        # Read after the snapshots: a file folded in the meantime is then
+        # already listed in the totals and skipped below
+        exited = _read_json(os.path.join(METRICS_FOLDER, EXITED_FILE))
+        if exited:
+            for sid in exited.get('folded', {}):
+                snapshots.pop(sid, None)
+            snapshots['exited'] = dict(exited, pid=None, alive=False, gauges=[])
+        if dead_files:
+            _fold_exited(dead_files)
+    # This process's live values are fresher than its last flush
+    live = _snapshot()
+    snapshots[_snapshot_id(live)] = dict(live, alive=True)
+    return snapshots.values()
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+def render():
+    """Merge every process's snapshot into Prometheus text exposition format"""
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in _load_snapshots():
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        if snapshot['alive']:
+            for name, labels, value in snapshot['gauges']:
+                labels = tuple(map(tuple, labels)) + (('pid', snapshot['pid']),)
+                gauges[(name, labels)] = value
+        for name, labels, buckets in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [0] * len(buckets))
+            for i, value in enumerate(buckets):
+                merged[i] += value
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (metric, labels), value in sorted(gauges.items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (metric, labels), buckets in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {buckets[-1]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {buckets[-2]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {buckets[-1]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,122 @@
+"""Output encoding for cropped images: format, quality, target file size and pixel size.
+
+Defaults come from config.py. /process requests and bulk_crop.py can
+override them for a batch. Encoding runs inside the crop worker processes
+(see batch.py), so the encodes of a batch run in parallel.
+"""
+import cv2
+
+from config import (MIN_OUTPUT_QUALITY, OUTPUT_FORMAT, OUTPUT_QUALITY, OUTPUT_SIZE,
+                    PRESERVE_ORIGINAL_FORMAT, PROGRESSIVE_JPEG, TARGET_FILE_SIZE_KB)
+
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+EXTENSION_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp'}
+# Inputs that keep their format; others (GIF, video) become JPEG
+STILL_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff'}
+LOSSY_FORMATS = {'jpeg', 'webp'}
+TARGET_SEARCH_STEPS = 6  # Encodes tried at most when searching for a target size
+MAX_OUTPUT_SIDE = 10000
+
+
+def parse_size(size):
+    """``[width, height]`` from a (width, height) pair or a 'WxH' string; None stays None"""
+    if size is None:
+        return None
+    if isinstance(size, str):
+        parts = size.lower().split('x')
+        if len(parts) != 2 or not all(p.strip().isdigit() for p in parts):
+            raise ValueError("Size must look like WIDTHxHEIGHT, e.g. 413x531")
+        size = [int(p) for p in parts]
+    if (not isinstance(size, (list, tuple)) or len(size) != 2
+            or any(isinstance(v, bool) or not isinstance(v, int) or not 1 <= v <= MAX_OUTPUT_SIDE
+                   for v in size)):
+        raise ValueError(f"Size must be two whole numbers of pixels from 1 to {MAX_OUTPUT_SIDE}")
+    return [size[0], size[1]]
+
+def encoding_options(format=None, quality=None, progressive=None, target_kb=None, size=None):
+    """Validated encoding options, with config.py defaults for anything not given.
+
+    ``format`` is 'jpeg', 'png', 'webp' or 'original' (keep the input's
+    format). ``size`` is the output (width, height) in pixels or a 'WxH'
+    string. Raises ValueError for invalid values.
+    """
+    if format is None:
+        format = 'original' if PRESERVE_ORIGINAL_FORMAT else OUTPUT_FORMAT
+    format = str(format).lower()
+    if format == 'jpg':
+        format = 'jpeg'
+    if format != 'original' and format not in FORMAT_EXTENSIONS:
+        raise ValueError(f"Unsupported output format: {format}")
+
+    quality = OUTPUT_QUALITY if quality is None else quality
+    if isinstance(quality, bool) or not isinstance(quality, int) or not 1 <= quality <= 100:
+        raise ValueError("Quality must be an integer from 1 to 100")
+
+    progressive = PROGRESSIVE_JPEG if progressive is None else progressive
+    if not isinstance(progressive, bool):
+        raise ValueError("Progressive must be true or false")
+
+    target_kb = TARGET_FILE_SIZE_KB if target_kb is None else target_kb
+    if isinstance(target_kb, bool) or not isinstance(target_kb, int) or target_kb < 0:
+        raise ValueError("Target size must be a whole number of KB (0 = no target)")
+
+    size = parse_size(OUTPUT_SIZE if size is None else size)
+
+    return {'format': format, 'quality': quality, 'progressive': progressive,
+            'target_kb': target_kb, 'size': size}
+
+def output_extension(input_path, options):
+    """Extension of the encoded output for ``input_path``"""
+    if options['format'] == 'original':
+        ext = '.' + input_path.rsplit('.', 1)[-1].lower()
+        return ext if ext in STILL_EXTENSIONS else FORMAT_EXTENSIONS['jpeg']
+    return FORMAT_EXTENSIONS[options['format']]
+
+def encode_params(fmt, quality, progressive):
+    """cv2.imencode parameters for a format"""
+    if fmt == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, quality,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive),
+                cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    if fmt == 'webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return []
+
+def _encode(image, ext, fmt, quality, progressive):
+    ok, buffer = cv2.imencode(ext, image, encode_params(fmt, quality, progressive))
+    if not ok:
+        raise ValueError(f"Could not encode {ext} image")
+    return buffer
+
+def encode_image(image, ext, options):
+    """Encode a BGR array for a file with extension ``ext``; returns the bytes buffer.
+
+    With a target size, lossy formats are searched for the highest quality
+    between MIN_OUTPUT_QUALITY and the requested quality that fits. The
+    search is a bisection capped at TARGET_SEARCH_STEPS encodes; if nothing
+    fits, the smallest encode is returned.
+    """
+    fmt = EXTENSION_FORMATS.get(ext.lower())
+    quality, progressive = options['quality'], options['progressive']
+    buffer = _encode(image, ext, fmt, quality, progressive)
+
+    target = options['target_kb'] * 1024
+    if not target or fmt not in LOSSY_FORMATS or buffer.size <= target:
+        return buffer
+
+    low, high = min(MIN_OUTPUT_QUALITY, quality), quality - 1
+    best = smallest = None
+    for _ in range(TARGET_SEARCH_STEPS):
+        if low > high:
+            break
+        mid = (low + high) // 2
+        candidate = _encode(image, ext, fmt, mid, progressive)
+        if candidate.size <= target:
+            best, low = candidate, mid + 1
+        else:
+            high = mid - 1
+            if smallest is None or candidate.size < smallest.size:
+                smallest = candidate
+    if best is not None:
+        return best
+    return smallest if smallest is not None else buffer
@@ -0,0 +1,98 @@
+"""Session and file-ownership store for app_cloud.py, shared by all workers.
+
+Sessions and the files they own live in a WAL-mode SQLite database, so
+every gunicorn worker sees the same state. Ownership checks are primary-key
+lookups, and expiry walks an index on ``expires_at`` instead of scanning
+every session.
+"""
+import time
+
+from sqlite_store import SQLiteStore
+
+UPLOAD = 'upload'
+PROCESSED = 'processed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
+CREATE TABLE IF NOT EXISTS session_files (
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    added_at REAL NOT NULL,
+    PRIMARY KEY (user_id, kind, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS session_files_path ON session_files (path);
+"""
+
+
+class SessionStore(SQLiteStore):
+    """User sessions and the uploads/outputs each one owns"""
+
+    def __init__(self, db_path, timeout):
+        self.timeout = timeout  # Session lifetime in seconds
+        super().__init__(db_path, SCHEMA)
+
+    def ensure(self, user_id):
+        """Create the session if it does not exist yet"""
+        now = time.time()
+        self._conn().execute(
+            'INSERT OR IGNORE INTO sessions (user_id, created_at, expires_at) VALUES (?, ?, ?)',
+            (user_id, now, now + self.timeout))
+
+    def add_file(self, user_id, kind, path):
+        """Record that the session owns ``path`` (idempotent)"""
+        self._conn().execute(
+            'INSERT OR IGNORE INTO session_files (user_id, kind, path, added_at) VALUES (?, ?, ?, ?)',
+            (user_id, kind, path, time.time()))
+
+    def owns(self, user_id, kind, path):
+        row = self._conn().execute(
+            'SELECT 1 FROM session_files WHERE user_id = ? AND kind = ? AND path = ?',
+            (user_id, kind, path)).fetchone()
+        return row is not None
+
+    def files(self, user_id, kind):
+        """Paths the session owns, oldest first"""
+        return [row[0] for row in self._conn().execute(
+            'SELECT path FROM session_files WHERE user_id = ? AND kind = ? ORDER BY added_at',
+            (user_id, kind))]
+
+    def count(self, user_id, kind):
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM session_files WHERE user_id = ? AND kind = ?',
+            (user_id, kind)).fetchone()[0]
+
+    def delete(self, user_id):
+        """Delete a session; returns (kind, path) pairs no other session still uses"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            owned = conn.execute(
+                'SELECT kind, path FROM session_files WHERE user_id = ?', (user_id,)).fetchall()
+            conn.execute('DELETE FROM session_files WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            orphaned = [
+                (kind, path) for kind, path in owned
+                if conn.execute('SELECT 1 FROM session_files WHERE path = ? LIMIT 1',
+                                (path,)).fetchone() is None
+            ]
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return orphaned
+
+    def forget(self, path):
+        """Drop every session's claim on ``path`` (after the janitor evicts it)"""
+        self._conn().execute('DELETE FROM session_files WHERE path = ?', (path,))
+
+    def expired(self, now=None):
+        """IDs of sessions past their expiry time, oldest first"""
+        now = time.time() if now is None else now
+        return [row[0] for row in self._conn().execute(
+            'SELECT user_id FROM sessions WHERE expires_at <= ? ORDER BY expires_at', (now,))]
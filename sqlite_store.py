@@ -0,0 +1,30 @@
+"""Base class for the SQLite stores shared by every worker process.
+
+Each store keeps its own WAL-mode database. Connections are opened per
+thread, since sqlite3 connections must not cross threads, and reopened
+after a fork so a worker never uses its parent's connection.
+"""
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """A WAL-mode SQLite file at ``db_path`` with ``schema`` applied"""
+
+    def __init__(self, db_path, schema):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(schema)
+
+    def _conn(self):
+        """One connection per thread, reopened after fork"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -22,7 +22,7 @@ def test_cropping():
         
         # Now process the uploaded image
         image_paths = [test_image_path]
-        process_data = {'image_paths': image_paths}
+        process_data = {'image_paths': image_paths, 'wait': True}
         
         process_response = requests.post('http://localhost:5000/process', 
                                        json=process_data,
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Check the vectorized crop geometry against the original per-image code
+
+crop_geometry.py replaced scalar functions in cropper.py. The reference
+versions below are those functions as they were, with their constants read
+from config.py; random face boxes and image sizes must give identical
+rectangles either way. Runs as a script or under pytest.
+"""
+
+import numpy as np
+
+import crop_geometry
+from config import (CROP_ASPECT_RATIO, CROP_EXPANSION_HEIGHT, CROP_EXPANSION_WIDTH,
+                    MIN_CROP_HEIGHT, MIN_CROP_WIDTH)
+
+CASES = 20000
+SEED = 12
+
+
+def scalar_face_crop(box, h, w):
+    """The original plan_face_crop"""
+    xmin, ymin, box_width, box_height = box
+    x = int(xmin * w)
+    y = int(ymin * h)
+    width = int(box_width * w)
+    height = int(box_height * h)
+
+    expanded_height = int(height * CROP_EXPANSION_HEIGHT)
+    expanded_width = int(width * CROP_EXPANSION_WIDTH)
+
+    start_x = max(0, x - (expanded_width - width) // 2)
+    start_y = max(0, y - (expanded_height - height) // 2)
+    end_x = min(w, start_x + expanded_width)
+    end_y = min(h, start_y + expanded_height)
+
+    if end_x - start_x < MIN_CROP_WIDTH:
+        center_x = (start_x + end_x) // 2
+        start_x = max(0, center_x - MIN_CROP_WIDTH // 2)
+        end_x = min(w, center_x + MIN_CROP_WIDTH // 2)
+
+    if end_y - start_y < MIN_CROP_HEIGHT:
+        center_y = (start_y + end_y) // 2
+        start_y = max(0, center_y - MIN_CROP_HEIGHT // 2)
+        end_y = min(h, center_y + MIN_CROP_HEIGHT // 2)
+
+    return [start_x, start_y, end_x - start_x, end_y - start_y]
+
+def scalar_center_crop(h, w):
+    """The original plan_center_crop"""
+    center_x, center_y = w // 2, h // 2
+    crop_size = min(w, h) // 2
+    return [max(0, center_x - crop_size // 2), max(0, center_y - crop_size // 2),
+            min(crop_size, w), min(crop_size, h)]
+
+def scalar_fit_aspect(rect):
+    """The trim done by the original crop_to_aspect, as a rectangle"""
+    x, y, w, h = rect
+    target_ratio = 1.0 / CROP_ASPECT_RATIO
+    current_ratio = w / h
+    if current_ratio > target_ratio:
+        new_width = int(h * target_ratio)
+        return [x + (w - new_width) // 2, y, new_width, h]
+    if current_ratio < target_ratio:
+        new_height = int(w / target_ratio)
+        return [x, y + (h - new_height) // 2, w, new_height]
+    return [x, y, w, h]
+
+def random_cases(count=CASES, seed=SEED):
+    """Relative face boxes (some reaching past the edges), image sizes and found flags"""
+    rng = np.random.default_rng(seed)
+    boxes = np.column_stack([
+        rng.uniform(-0.2, 1.0, count),
+        rng.uniform(-0.2, 1.0, count),
+        rng.uniform(0.0, 0.8, count),
+        rng.uniform(0.0, 0.8, count),
+    ])
+    sizes = rng.integers(16, 6000, size=(count, 2))
+    found = rng.random(count) < 0.9
+    return boxes, sizes, found
+
+
+def test_face_crops_match():
+    boxes, sizes, _ = random_cases()
+    rects = crop_geometry.expand_face_boxes(boxes, sizes)
+    for box, (h, w), rect in zip(boxes.tolist(), sizes.tolist(), rects.tolist()):
+        assert rect == scalar_face_crop(box, h, w), (box, h, w)
+
+def test_center_crops_match():
+    _, sizes, _ = random_cases()
+    rects = crop_geometry.center_boxes(sizes)
+    for (h, w), rect in zip(sizes.tolist(), rects.tolist()):
+        assert rect == scalar_center_crop(h, w), (h, w)
+
+def test_planned_crops_match():
+    boxes, sizes, found = random_cases()
+    rects = crop_geometry.final_crop_rects(boxes, sizes, found)
+    for box, (h, w), hit, rect in zip(boxes.tolist(), sizes.tolist(), found.tolist(),
+                                      rects.tolist()):
+        planned = scalar_face_crop(box, h, w) if hit else scalar_center_crop(h, w)
+        if planned[2] > 0 and planned[3] > 0:  # The old trim divided by zero on empty crops
+            assert rect == scalar_fit_aspect(planned), (box, h, w, hit)
+
+
+if __name__ == "__main__":
+    for test in (test_face_crops_match, test_center_crops_match, test_planned_crops_match):
+        test()
+        print(f"✅ {test.__name__}: {CASES} cases")
@@ -1,59 +1,113 @@
+#!/usr/bin/env python3
+"""
+Check that hair refinement moves the crop's top edge to the top of the head
+
+The tests draw a head on a plain background, so they need neither MediaPipe
+nor a sample photo; a face box stands in for the detector. Run as a script
+with a photo path to also save the proxy's edge map, search band and hair
+line to edges_debug.jpg. Runs as a script or under pytest.
+"""
+
+import sys
+from types import SimpleNamespace
+
 import cv2
 import numpy as np
-import os
 
-def test_hair_detection():
-    image_path = "uploads/DSC_6555.JPG"
-    
-    if not os.path.exists(image_path):
-        print(f"Image not found: {image_path}")
+import crop_geometry
+from config import HAIR_TOP_MARGIN
+from cropper import load_detection_proxy, plan_face_crop, refine_hair_top
+from hair_detection import CANNY_HIGH, CANNY_LOW, hair_search_band, find_hair_top
+
+PROXY_SIZE = (600, 400)  # Proxy height, width
+SCALE = 4                # Full resolution is SCALE times the proxy
+FACE = SimpleNamespace(xmin=0.35, ymin=0.4, width=0.3, height=0.2)
+HAIR_ROW = 200           # Proxy row where the drawn head starts
+
+
+def face_box(bbox, proxy):
+    """The relative face box in proxy pixels, as refine_hair_top computes it"""
+    ph, pw = proxy.shape[:2]
+    return (int(bbox.xmin * pw), int(bbox.ymin * ph), int(bbox.width * pw), int(bbox.height * ph))
+
+def portrait_proxy(hair_row=HAIR_ROW):
+    """A light background with a dark head from ``hair_row`` down (None = no head)"""
+    ph, pw = PROXY_SIZE
+    proxy = np.full((ph, pw, 3), 220, dtype=np.uint8)
+    if hair_row is not None:
+        x, _, w, _ = face_box(FACE, proxy)
+        cv2.rectangle(proxy, (x - 20, hair_row), (x + w + 20, ph - 1), (40, 40, 40), -1)
+    return proxy
+
+def refine(proxy):
+    """``(planned, refined)`` full-resolution crops for FACE on ``proxy``"""
+    h, w = PROXY_SIZE[0] * SCALE, PROXY_SIZE[1] * SCALE
+    planned = plan_face_crop(FACE, h, w)
+    return planned, refine_hair_top(proxy, FACE, planned, h, w)
+
+def fitted_top(coords):
+    """Top edge of a crop once it is trimmed to the ID-card aspect ratio"""
+    rect = (coords['x'], coords['y'], coords['width'], coords['height'])
+    return int(crop_geometry.fit_aspect_ratio(rect)[0, 1])
+
+
+def test_hair_top_found():
+    proxy = portrait_proxy()
+    hair_top = find_hair_top(proxy, face_box(FACE, proxy))
+    assert hair_top is not None
+    assert abs(hair_top - HAIR_ROW) <= 2, hair_top
+
+def test_refined_top_edge():
+    proxy = portrait_proxy()
+    planned, refined = refine(proxy)
+    hair_top = find_hair_top(proxy, face_box(FACE, proxy))
+    h = PROXY_SIZE[0] * SCALE
+    expected = hair_top * SCALE - int(FACE.height * h * HAIR_TOP_MARGIN)
+    assert fitted_top(refined) == expected, (fitted_top(refined), expected)
+    assert fitted_top(refined) != fitted_top(planned)
+    # Only the vertical position changes
+    assert (refined['x'], refined['width'], refined['height']) == \
+        (planned['x'], planned['width'], planned['height'])
+
+def test_no_hair_keeps_crop():
+    planned, refined = refine(portrait_proxy(hair_row=None))
+    assert refined == planned
+
+
+def save_edge_debug(image_path, output_path="edges_debug.jpg"):
+    """Detect the face in a photo and save the proxy's edge map with the hair search drawn in"""
+    from face_detector import get_face_detector
+
+    proxy, full_size = load_detection_proxy(image_path)
+    if proxy is None:
+        print(f"Could not read image: {image_path}")
         return
-    
-    # Read image
-    image = cv2.imread(image_path)
-    if image is None:
-        print("Could not read image")
+    h, w = full_size
+    results = get_face_detector().process(cv2.cvtColor(proxy, cv2.COLOR_BGR2RGB))
+    if not results.detections:
+        print("No face detected")
         return
-    
-    h, w, _ = image.shape
-    print(f"Image dimensions: {w} x {h}")
-    
-    # Convert to grayscale for better edge detection
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # Apply Gaussian blur to reduce noise
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    
-    # Use Canny edge detection
-    edges = cv2.Canny(blurred, 50, 150)
-    
-    # Scan from top to bottom to find the first significant edge content
-    hair_start_y = 0
-    for scan_y in range(0, min(h//3, 300)):  # Scan top 33% or 300px
-        # Get a horizontal slice of the edge image
-        slice_edges = edges[scan_y:scan_y+1, :]
-        
-        # Count non-zero pixels (edges) in this slice
-        edge_count = np.count_nonzero(slice_edges)
-        
-        print(f"Scan y={scan_y}: edge_count={edge_count}, threshold={w * 0.1}")
-        
-        # If we find significant edges (likely hair/head boundary), mark this position
-        if edge_count > w * 0.1:  # If more than 10% of width has edges
-            hair_start_y = scan_y
-            print(f"Found hair start at y={hair_start_y}")
-            break
-    
-    # Add 0.5cm above the detected hair start point
-    # Assuming standard DPI, 0.5cm ≈ 19 pixels
-    extra_space = 19
-    start_y = max(0, hair_start_y - extra_space)
-    
-    print(f"Final crop start_y: {start_y}")
-    
-    # Save the edge detection result for visualization
-    cv2.imwrite("edges_debug.jpg", edges)
-    print("Saved edge detection result to edges_debug.jpg")
+
+    bbox = results.detections[0].location_data.relative_bounding_box
+    box = face_box(bbox, proxy)
+    x0, y0, x1, y1 = hair_search_band(box)
+    hair_top = find_hair_top(proxy, box)
+    crop_coords = plan_face_crop(bbox, h, w)
+    refined = refine_hair_top(proxy, bbox, crop_coords, h, w)
+    print(f"Hair top (proxy): {hair_top}, crop start_y: {crop_coords['y']} -> {refined['y']}")
+
+    gray = cv2.GaussianBlur(cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    edges = cv2.cvtColor(cv2.Canny(gray, CANNY_LOW, CANNY_HIGH), cv2.COLOR_GRAY2BGR)
+    cv2.rectangle(edges, (x0, y0), (x1, y1), (0, 255, 0), 1)
+    if hair_top is not None:
+        cv2.line(edges, (x0, hair_top), (x1, hair_top), (0, 0, 255), 1)
+    cv2.imwrite(output_path, edges)
+    print(f"Saved edge detection result to {output_path}")
+
 
 if __name__ == "__main__":
-    test_hair_detection()
+    for test in (test_hair_top_found, test_refined_top_edge, test_no_hair_keeps_crop):
+        test()
+        print(f"✅ {test.__name__}")
+    if len(sys.argv) > 1:
+        save_edge_debug(sys.argv[1])
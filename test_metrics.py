@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Check that crop counters recorded by the pipeline show up on /metrics
+
+Runs app.py's test client in a temporary folder, so its databases and
+metric snapshots do not touch the working tree. Runs as a script or under
+pytest.
+"""
+
+import importlib
+import os
+import tempfile
+
+import metrics
+from cropper import locate_faces
+from detection_store import DetectionStore
+
+STORED_KEY = 'a' * 64
+MISSING_KEY = 'b' * 64
+
+
+def test_detection_store_counter():
+    cwd, folder = os.getcwd(), metrics.METRICS_FOLDER
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        metrics.METRICS_FOLDER = os.path.join(tmp, 'metrics_data')
+        try:
+            app = importlib.import_module('app').app
+            store = DetectionStore(os.path.join(tmp, 'detections.db'), {'test': 1})
+            store.put(STORED_KEY, (200, 160), [])
+
+            locate_faces(None, store=store, key=STORED_KEY)
+            try:
+                locate_faces(None, store=store, key=MISSING_KEY, stored_only=True)
+            except LookupError:
+                pass
+            else:
+                raise AssertionError("A recrop without stored detections should fail")
+
+            body = app.test_client().get('/metrics').get_data(as_text=True)
+        finally:
+            os.chdir(cwd)
+            metrics.METRICS_FOLDER = folder
+
+    assert '# TYPE crop_detection_store_total counter' in body
+    assert 'crop_detection_store_total{result="hit"} 1' in body
+    assert 'crop_detection_store_total{result="miss"} 1' in body
+
+
+if __name__ == "__main__":
+    test_detection_store_counter()
+    print("✅ test_detection_store_counter")
@@ -0,0 +1,47 @@
+"""Incremental multipart parsing for upload-and-crop requests.
+
+werkzeug's request.files reads (and spools to disk) the whole body before
+the view runs. Here the body is parsed from the request stream as it
+arrives, and each file part is handed over as soon as its last byte is in,
+while later parts are still on the wire. Part bytes are kept in memory only;
+nothing is written to disk.
+"""
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+
+READ_SIZE = 64 * 1024  # Bytes read from the request stream at a time
+
+
+def multipart_boundary(content_type):
+    """Boundary of a multipart/form-data Content-Type; raises ValueError for anything else"""
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise ValueError("Expected a multipart/form-data body")
+    return boundary.encode()
+
+def iter_file_parts(stream, boundary, field_name='files[]', max_parts=None):
+    """Yield ``(filename, data)`` for each file part of a multipart body, as it completes.
+
+    Parts of other fields are skipped.
+    """
+    decoder = MultipartDecoder(boundary, max_parts=max_parts)
+    filename, chunks = None, None
+    finished = False
+    while not finished:
+        block = stream.read(READ_SIZE)
+        decoder.receive_data(block or None)
+        finished = not block
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                break
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, File):
+                filename, chunks = (event.filename, []) if event.name == field_name else (None, None)
+            elif isinstance(event, Data) and chunks is not None:
+                chunks.append(event.data)
+                if not event.more_data:
+                    yield filename, b''.join(chunks)
+                    filename, chunks = None, None
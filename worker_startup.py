@@ -0,0 +1,66 @@
+"""Worker start-up timing and detector warm-up for app.py and app_cloud.py.
+
+With preload_app the gunicorn master imports the app once and forks the web
+workers, which are recycled every max_requests. MediaPipe is only imported
+where crops run (see face_detector.py), and the post_fork hook warms the
+detector there before the worker takes requests, so the first /process does
+not pay for graph start-up. The timings are reported as gauges on /metrics:
+crop_startup_seconds{phase="import"|"warmup"|"detector"} and
+crop_first_request_seconds.
+
+The apps import this module first, so its clock covers their imports.
+Nothing is recorded into metrics until after the fork: the master must not
+start the metrics flusher thread, whose lock a forked worker could inherit
+held.
+"""
+import time
+
+_import_started = time.perf_counter()
+
+import os
+
+from flask import g
+
+import metrics
+
+_state = {'import_seconds': None, 'pid': None}
+
+
+def app_imported():
+    """Call at the end of the app module: the app has finished importing"""
+    _state['import_seconds'] = time.perf_counter() - _import_started
+
+def _record_import():
+    if _state['import_seconds'] is not None:
+        metrics.set_gauge('crop_startup_seconds', _state['import_seconds'], phase='import')
+
+def warm_up():
+    """Warm the face detector where this worker's crops run; called from post_fork
+
+    Then start the job runner, so jobs other workers left unfinished are
+    resumed without waiting for this worker's first request.
+    """
+    from batch import warm_up_detectors
+    from jobs import start_job_runner
+
+    _record_import()
+    started = time.perf_counter()
+    warm_up_detectors()
+    metrics.set_gauge('crop_startup_seconds', time.perf_counter() - started, phase='warmup')
+    start_job_runner()
+
+def track_first_request(app):
+    """Record the latency of the first request each worker process serves"""
+    @app.before_request
+    def start_first_request_timer():
+        if _state['pid'] != os.getpid():
+            _state['pid'] = os.getpid()
+            g.first_request_started = time.perf_counter()
+
+    @app.after_request
+    def record_first_request(response):
+        started = g.pop('first_request_started', None)
+        if started is not None:
+            _record_import()
+            metrics.set_gauge('crop_first_request_seconds', time.perf_counter() - started)
+        return response
@@ -0,0 +1,60 @@
+"""Stream a ZIP of processed images to the client as it is built.
+
+Nothing is staged on disk and the archive is never held in memory: each
+file is copied into the ZIP in fixed-size blocks and the bytes are handed to
+the response as soon as zipfile writes them. JPEG/PNG outputs barely
+compress, so entries are stored rather than deflated.
+"""
+import os
+import zipfile
+
+COPY_BLOCK_SIZE = 256 * 1024  # Bytes copied from each file at a time
+
+
+class _StreamSink:
+    """Write-only, unseekable file object that collects zipfile's output"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(file_paths):
+    """Yield the bytes of a stored (uncompressed) ZIP of ``file_paths``.
+
+    Entries are named by basename; missing files and repeated names are
+    skipped.
+    """
+    sink = _StreamSink()
+    seen = set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for path in file_paths:
+            arcname = os.path.basename(path)
+            if arcname in seen or not os.path.isfile(path):
+                continue
+            seen.add(arcname)
+
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, archive.open(info, 'w', force_zip64=True) as dst:
+                for block in iter(lambda: src.read(COPY_BLOCK_SIZE), b''):
+                    dst.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # Central directory is written when the archive closes
+    yield sink.drain()